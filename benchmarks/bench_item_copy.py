@@ -0,0 +1,82 @@
+# Compares the old deepcopy based item transforms with the shallow copies
+# EncryptionHelper and sync_items use now, in time and allocations.
+#
+#   python benchmarks/bench_item_copy.py --note-kb 512 --items 200
+
+import argparse
+from copy import deepcopy
+import json
+import os
+import sys
+from time import perf_counter
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from standardnotes_fs.crypt import EncryptionHelper
+
+def measure(func, items):
+    # keep every result alive, like a sync batch does
+    tracemalloc.start()
+    start = perf_counter()
+    results = [func(item) for item in items]
+    elapsed = perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return dict(seconds=round(elapsed, 4), peak_kb=round(peak / 1024, 1))
+
+def make_items(count, note_kb, references):
+    return [dict(uuid='item-%d' % i, content_type='Note', deleted=False,
+                 created_at='2020-01-01T00:00:00.000Z',
+                 updated_at='2020-01-01T00:00:00.000Z',
+                 content=dict(title='Note %d' % i, text='x' * (note_kb * 1024),
+                              references=[dict(uuid='ref-%d' % r, content_type='Tag')
+                                          for r in range(references)],
+                              appData={'org.standardnotes.sn': dict(
+                                  client_updated_at='2020-01-01T00:00:00.000Z')}))
+            for i in range(count)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--note-kb', type=int, default=64)
+    parser.add_argument('--references', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='print JSON only')
+    args = parser.parse_args()
+
+    helper = EncryptionHelper()
+    keys = helper.generate_password_and_key('benchmark', 'salt', 1000)
+    items = make_items(args.items, args.note_kb, args.references)
+    enc_items = [helper.encrypt_item(item, keys) for item in items]
+
+    def old_encrypt(item):
+        # sync_items deepcopied, then encrypt_item deepcopied again
+        enc_item = deepcopy(deepcopy(item))
+        enc_item.update(helper.encrypt_item(item, keys))
+        return enc_item
+
+    def old_decrypt(item):
+        dec_item = deepcopy(item)
+        dec_item.update(helper.decrypt_item(item, keys))
+        return dec_item
+
+    results = dict(
+        snapshot_deepcopy=measure(deepcopy, items),
+        snapshot_shallow=measure(dict, items),
+        encrypt_deepcopy=measure(old_encrypt, items),
+        encrypt_shallow=measure(lambda i: helper.encrypt_item(i, keys), items),
+        decrypt_deepcopy=measure(old_decrypt, enc_items),
+        decrypt_shallow=measure(lambda i: helper.decrypt_item(i, keys), enc_items),
+    )
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    for name, result in results.items():
+        print('%-18s %8.4f s  peak %10.1f KiB' % (name, result['seconds'],
+                                                  result['peak_kb']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# Times the ItemManager and EncryptionHelper hot paths on synthetic accounts
+# and records peak memory, against a fake sync server that skips serializing.
+#
+#   python benchmarks/bench_suite.py --json > results.json
+#   python benchmarks/bench_suite.py --compare results.json --tolerance 0.25
+
+import argparse
+from copy import deepcopy
+import json
+import os
+import platform
+import sys
+from time import perf_counter
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_server import FakeSyncServer, connect
+from standardnotes_fs.itemmanager import ItemManager
+
+EMAIL = 'benchmark@example.com'
+PASSWORD = 'benchmark'
+DATE = '2020-01-01T00:00:%02d.%03dZ'
+GET_NOTES_CALLS = 200
+
+def make_api():
+    # an empty account, so sync_items only pays for encrypting, decrypting
+    # and mapping what it sends
+    server = FakeSyncServer(wire=False)
+    server.register(EMAIL, PASSWORD)
+    return connect(server, EMAIL, PASSWORD)
+
+def make_manager(sn_api, items=()):
+    manager = ItemManager(sn_api, '.txt')
+    manager.map_items([dict(item) for item in items])
+    return manager
+
+def make_item(i, content_type, content):
+    date = DATE % (i // 1000 % 60, i % 1000)
+    return dict(uuid='00000000-0000-4000-8000-%012d' % i,
+                content_type=content_type, deleted=False,
+                created_at=date, updated_at=date, content=content)
+
+def make_account(notes, note_bytes, titles, tags, tagged):
+    text = ('lorem ipsum dolor sit amet\n' * (note_bytes // 27 + 1))[:note_bytes]
+    items = [make_item(i, 'Note', dict(title='Note %d' % (i % titles),
+                                       text=text, references=[]))
+             for i in range(notes)]
+
+    # every tag references the first `tagged` notes
+    references = [dict(uuid=item['uuid'], content_type='Note')
+                  for item in items[:tagged]]
+    items += [make_item(notes + i, 'Tag', dict(title='Tag %d' % i,
+                                               references=references))
+              for i in range(tags)]
+    return items
+
+def scenarios(scale):
+    def n(x):
+        return max(1, int(x * scale))
+
+    return dict(
+        many_notes=make_account(n(5000), 200, n(5000), 10, 10),
+        large_notes=make_account(n(40), 512 * 1024, n(40), 1, n(40)),
+        duplicate_titles=make_account(n(3000), 200, 20, 1, 0),
+        heavy_tags=make_account(n(2000), 200, n(2000), 50, n(2000)),
+    )
+
+def bench_encrypt_item(sn_api, items):
+    helper, keys = sn_api.encryption_helper, sn_api.keys
+    def run():
+        for item in items:
+            helper.encrypt_item(item, keys)
+    return run, len(items)
+
+def bench_decrypt_item(sn_api, items):
+    keys = sn_api.keys
+    enc_items = [sn_api.encryption_helper.encrypt_item(item, keys)
+                 for item in items]
+
+    # a new helper each time, so item keys are unwrapped like a first sync
+    helper = type(sn_api.encryption_helper)()
+    def run():
+        for item in enc_items:
+            helper.decrypt_item(item, keys)
+    return run, len(items)
+
+def bench_map_items(sn_api, items):
+    manager = make_manager(sn_api)
+    # map_items replaces the content of what it's given
+    items = [dict(item) for item in items]
+    return lambda: manager.map_items(items), len(items)
+
+def bench_cache_item_title(sn_api, items):
+    manager = make_manager(sn_api)
+    items = sorted(items, key=lambda x: x['created_at'])
+    uuid_cache = {}
+    title_cache = {}
+    def run():
+        for item in items:
+            manager.cache_item_title(item, uuid_cache, title_cache)
+    return run, len(items)
+
+def bench_get_notes(sn_api, items):
+    manager = make_manager(sn_api, items)
+    def run():
+        for _ in range(GET_NOTES_CALLS):
+            manager.get_notes()
+    return run, GET_NOTES_CALLS
+
+def bench_get_note(sn_api, items):
+    manager = make_manager(sn_api, items)
+    titles = manager.get_notes()
+    def run():
+        for title in titles:
+            manager.get_note(title)
+    return run, len(titles)
+
+def bench_sync_items(sn_api, items):
+    manager = make_manager(sn_api, items)
+    notes = [uuid for uuid in manager.note_titles]
+    for uuid in notes:
+        manager.touch_note(uuid)
+    return manager.sync_items, len(notes)
+
+BENCHMARKS = [
+    bench_encrypt_item,
+    bench_decrypt_item,
+    bench_map_items,
+    bench_cache_item_title,
+    bench_get_notes,
+    bench_get_note,
+    bench_sync_items,
+]
+
+def measure(bench, items, rounds):
+    # timing and tracemalloc are separate runs, tracing slows everything down,
+    # and each gets a new API so nothing is left in its cache or token
+    times = []
+    for _ in range(rounds):
+        run, ops = bench(make_api(), deepcopy(items))
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+
+    run, ops = bench(make_api(), deepcopy(items))
+    tracemalloc.start()
+    run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = min(times)
+    return dict(seconds=round(best, 5), ops=ops,
+                ops_per_sec=round(ops / best, 1) if best else None,
+                peak_kb=round(peak / 1024, 1))
+
+def compare(results, baseline, tolerance):
+    # only time is compared, memory is reported for people to read
+    old = {(r['scenario'], r['bench']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = old.get((result['scenario'], result['bench']))
+        if before and result['seconds'] > before['seconds'] * (1 + tolerance):
+            regressions.append('%s %s: %.5f s -> %.5f s' % (result['scenario'],
+                result['bench'], before['seconds'], result['seconds']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of notes in each account')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='timed rounds per benchmark, the best is kept')
+    parser.add_argument('--scenario', action='append',
+                        help='only run this account, can be repeated')
+    parser.add_argument('--bench', action='append',
+                        help='only run this benchmark, can be repeated')
+    parser.add_argument('--json', action='store_true', help='print JSON only')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='exit 1 if slower than the JSON results in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown for --compare. Default: 0.25')
+    args = parser.parse_args()
+
+    accounts = scenarios(args.scale)
+    results = []
+
+    for scenario, items in accounts.items():
+        if args.scenario and scenario not in args.scenario:
+            continue
+        for bench in BENCHMARKS:
+            name = bench.__name__[len('bench_'):]
+            if args.bench and name not in args.bench:
+                continue
+            result = dict(scenario=scenario, bench=name)
+            result.update(measure(bench, items, max(1, args.rounds)))
+            results.append(result)
+            if not args.json:
+                print('%-17s %-17s %9.4f s %12s ops/s  peak %10.1f KiB' % (
+                      scenario, name, result['seconds'], result['ops_per_sec'],
+                      result['peak_kb']), flush=True)
+
+    output = dict(python=platform.python_version(), machine=platform.machine(),
+                  scale=args.scale, rounds=args.rounds, results=results)
+    if args.json:
+        print(json.dumps(output, indent=4))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# An in-process stand-in for a Standard Notes sync server. It answers
+# /auth/params, /auth/sign_in and /items/sync like the real one does for 003
+# accounts and plugs in where StandardNotesAPI keeps its RESTAPI:
+#
+#   server = FakeSyncServer(latency=0.05)
+#   keys = server.register('user@example.com', 'password')
+#   server.populate(keys, notes=100000)
+#   sn_api = connect(server, 'user@example.com', 'password')
+#
+# With wire=False nothing is serialized, so benchmarks only pay for the client.
+
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import random
+import sys
+from threading import Lock
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from standardnotes_fs.api import StandardNotesAPI
+from standardnotes_fs.crypt import EncryptionHelper
+
+FAKE_URL = 'http://fake-sync-server'
+DEFAULT_PW_COST = 1000
+DEFAULT_LIMIT = 150
+POPULATE_BATCH = 1000
+EPOCH = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+def timestamp(seconds):
+    date = EPOCH + timedelta(seconds=seconds)
+    return date.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (date.microsecond // 1000)
+
+class FakeSyncServer:
+    def _error(self, message, tag=None):
+        error = dict(message=message)
+        if tag:
+            error['tag'] = tag
+        return dict(error=error)
+
+    def _wire(self, data):
+        # what RESTAPI pays for, and no object is shared with the client
+        if not self.wire:
+            return data
+        body = json.dumps(data)
+        self.bytes_transferred += len(body)
+        return json.loads(body)
+
+    def _now(self):
+        # strictly increasing, so every save gets a new updated_at
+        self.clock = max(self.clock + 0.001, time.time() - EPOCH.timestamp())
+        return timestamp(self.clock)
+
+    def _store(self, item):
+        self.seq += 1
+        self.items[item['uuid']] = (self.seq, item)
+        self.log.append(self.seq)
+        self.log_uuids.append(item['uuid'])
+
+    def _changed_since(self, seq, skip_uuids, limit):
+        # the log is in seq order, entries for replaced items are skipped
+        changed = []
+        for i in range(bisect_right(self.log, seq), len(self.log)):
+            uuid = self.log_uuids[i]
+            if self.items[uuid][0] == self.log[i] and uuid not in skip_uuids:
+                changed.append(self.items[uuid])
+                if len(changed) > limit:
+                    break
+        return changed
+
+    def register(self, email, password, pw_cost=DEFAULT_PW_COST):
+        helper = EncryptionHelper()
+        pw_nonce = uuid4().hex
+        pw_salt = helper.generate_salt_from_nonce(email, '003', str(pw_cost),
+                                                  pw_nonce)
+        keys = helper.generate_password_and_key(password, pw_salt, pw_cost)
+        self.users[email] = dict(pw_cost=pw_cost, pw_nonce=pw_nonce,
+                                 pw=keys['pw'])
+        return keys
+
+    def populate(self, keys, notes=1000, note_bytes=1024, tags=10,
+                 tagged=100, titles=None, workers=1):
+        # items are encrypted with the account keys, like a real client made them
+        helper = EncryptionHelper(workers)
+        text = ('lorem ipsum dolor sit amet\n' * (note_bytes // 27 + 1))[:note_bytes]
+        titles = titles or notes
+        uuids = [str(uuid4()) for _ in range(notes)]
+
+        def make(uuid, content_type, content):
+            date = self._now()
+            return dict(uuid=uuid, content_type=content_type, deleted=False,
+                        created_at=date, updated_at=date, content=content)
+
+        for i in range(0, notes, POPULATE_BATCH):
+            batch = [make(uuid, 'Note', dict(title='Note %d' % (n % titles),
+                                             text=text, references=[]))
+                     for n, uuid in enumerate(uuids[i : i + POPULATE_BATCH], i)]
+            for item in helper.encrypt_dirty_items(batch, keys):
+                self._store(item)
+
+        references = [dict(uuid=uuid, content_type='Note')
+                      for uuid in uuids[:tagged]]
+        batch = [make(str(uuid4()), 'Tag', dict(title='Tag %d' % i,
+                                                references=references))
+                 for i in range(tags)]
+        for item in helper.encrypt_dirty_items(batch, keys):
+            self._store(item)
+
+        helper.shutdown()
+        return uuids
+
+    def touch(self, uuids):
+        # a change made by another client, the content stays the same
+        with self.lock:
+            for uuid in uuids:
+                seq, item = self.items[uuid]
+                self._store(dict(item, updated_at=self._now()))
+
+    def auth_params(self, params):
+        user = self.users.get(params.get('email'))
+        if not user:
+            return self._error('No account with that email.')
+        return dict(identifier=params['email'], version='003',
+                    pw_cost=user['pw_cost'], pw_nonce=user['pw_nonce'])
+
+    def sign_in(self, data):
+        user = self.users.get(data.get('email'))
+        if not user or user['pw'] != data.get('password'):
+            return self._error('Invalid email or password.')
+        token = uuid4().hex
+        self.tokens.add(token)
+        return dict(token=token, user=dict(email=data['email']))
+
+    def sync(self, data):
+        since = int(data.get('sync_token') or 0)
+        cursor = int(data.get('cursor_token') or 0)
+        limit = data.get('limit') or DEFAULT_LIMIT
+
+        saved = []
+        conflicts = []
+        for item in data.get('items', []):
+            current = self.items.get(item['uuid'])
+            if current and self.random.random() < self.conflict_rate:
+                # as if another client saved it first
+                self._store(dict(current[1], updated_at=self._now()))
+                current = self.items[item['uuid']]
+
+            # the client must have seen the server's latest copy
+            if current and item.get('updated_at') != current[1]['updated_at']:
+                conflicts.append(dict(type='sync_conflict',
+                                      server_item=current[1]))
+                continue
+
+            item = dict(item, updated_at=self._now())
+            item.setdefault('created_at', item['updated_at'])
+            item.setdefault('deleted', False)
+            self._store(item)
+            saved.append(item)
+
+        # conflicted items are only sent back as conflicts, like the server does
+        skip_uuids = ({item['uuid'] for item in saved}
+                      | {conflict['server_item']['uuid'] for conflict in conflicts})
+        changed = self._changed_since(max(since, cursor), skip_uuids, limit)
+        retrieved = [item for seq, item in changed[:limit]]
+
+        response = dict(retrieved_items=retrieved, saved_items=saved,
+                        conflicts=conflicts, sync_token=str(self.seq))
+        if len(changed) > limit:
+            response['cursor_token'] = str(changed[limit - 1][0])
+            # the next page must be read against the same sync_token
+            response['sync_token'] = str(since)
+        return response
+
+    # the RESTAPI interface StandardNotesAPI uses
+    def get(self, route, params=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if route == '/auth/params':
+                return self._wire(self.auth_params(params or {}))
+            return self._error('Not found.')
+
+    def post(self, route, data=None):
+        time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            data = self._wire(data or {})
+            if route == '/auth/sign_in':
+                return self._wire(self.sign_in(data))
+            if route == '/items/sync':
+                token = self.headers.get('Authorization', '')[len('Bearer '):]
+                if token not in self.tokens:
+                    return None
+                return self._wire(self.sync(data))
+            return self._error('Not found.')
+
+    def add_header(self, header):
+        self.headers.update(header)
+
+    def close(self):
+        pass
+
+    def __init__(self, latency=0, conflict_rate=0, seed=0, wire=True):
+        self.base_url = FAKE_URL
+        self.latency = latency
+        self.conflict_rate = conflict_rate
+        self.random = random.Random(seed)
+        self.wire = wire
+
+        self.lock = Lock()
+        self.headers = {}
+        self.users = {}
+        self.tokens = set()
+        self.items = {}
+        self.seq = 0
+        self.log = []
+        self.log_uuids = []
+        self.clock = 0
+
+        self.requests = 0
+        self.bytes_transferred = 0
+
+def connect(server, email, password, **kwargs):
+    # a signed in client of the fake server, kwargs go to StandardNotesAPI
+    sn_api = StandardNotesAPI(FAKE_URL, email, **kwargs)
+    sn_api.api = server
+    sn_api.sign_in(sn_api.gen_keys(password))
+    return sn_api
@@ -0,0 +1,203 @@
+# Mounts a large account from the in-process fake sync server and drives
+# StandardNotesFUSE the way the kernel would, without actually mounting it.
+# Reports mount time, per operation latency percentiles and sync throughput.
+#
+#   python benchmarks/load_harness.py --notes 100000 --latency 0.05
+#   python benchmarks/load_harness.py --notes 10000 --conflict-rate 0.1 --json
+
+import argparse
+import errno
+import json
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fuse import FuseOSError
+
+from fake_server import FakeSyncServer, connect
+from standardnotes_fs.sn_fuse import StandardNotesFUSE
+
+EMAIL = 'load@example.com'
+PASSWORD = 'load harness'
+READ_SIZE = 128 * 1024
+PERCENTILES = [50, 90, 99]
+
+def summarize(times):
+    times = sorted(times)
+    if not times:
+        return dict(ops=0)
+    result = dict(ops=len(times))
+    for p in PERCENTILES:
+        index = min(len(times) - 1, int(len(times) * p / 100))
+        result['p%d_ms' % p] = round(times[index] * 1000, 3)
+    result['max_ms'] = round(times[-1] * 1000, 3)
+    return result
+
+def timed(times, func, *args):
+    start = perf_counter()
+    result = func(*args)
+    times.append(perf_counter() - start)
+    return result
+
+# operations go through __call__ like fusepy dispatches them, so its checks,
+# metrics and logging are part of every latency
+def read_note(fs, path):
+    fh = fs('open', path, os.O_RDONLY)
+    offset = 0
+    while True:
+        data = fs('read', path, READ_SIZE, offset, fh)
+        offset += len(data)
+        if len(data) < READ_SIZE:
+            break
+    fs('release', path, fh)
+
+def write_note(fs, path, data):
+    # what an editor saving over a note looks like to FUSE
+    fh = fs('open', path, os.O_WRONLY)
+    fs('truncate', path, 0, fh)
+    fs('write', path, data, 0, fh)
+    fs('flush', path, fh)
+    fs('release', path, fh)
+
+def run(args):
+    rand = random.Random(args.seed)
+    server = FakeSyncServer(args.latency, args.conflict_rate, args.seed)
+    keys = server.register(EMAIL, PASSWORD, args.pw_cost)
+
+    start = perf_counter()
+    uuids = server.populate(keys, args.notes, args.note_bytes, args.tags,
+                            args.tagged, args.titles, args.crypto_workers)
+    populate_sec = perf_counter() - start
+
+    # mount: log in, then load and sync every item like main() does
+    start = perf_counter()
+    sn_api = connect(server, EMAIL, PASSWORD, page_size=args.page_size,
+                     crypto_workers=args.crypto_workers)
+    fs = StandardNotesFUSE(sn_api, args.sync_sec, '.txt')
+    mount_sec = perf_counter() - start
+    requests = server.requests
+
+    titles = fs.item_manager.get_notes()
+    tags = list(fs.item_manager.get_tags())
+    latency = dict(stat=[], readdir=[], readdir_tag=[], read=[], write=[])
+    errors = 0
+
+    for _ in range(args.ops):
+        path = '/' + rand.choice(titles)
+        timed(latency['stat'], fs, 'getattr', path)
+        timed(latency['read'], read_note, fs, path)
+
+    for _ in range(args.readdir_ops):
+        timed(latency['readdir'], fs, 'readdir', '/', None)
+        if tags:
+            timed(latency['readdir_tag'], fs, 'readdir',
+                  '/tags/' + rand.choice(tags), None)
+
+    written = set()
+    for i in range(args.writes):
+        path = '/' + rand.choice(titles)
+        try:
+            timed(latency['write'], write_note, fs, path,
+                  ('edit %d\n' % i).encode() * (args.note_bytes // 8 + 1))
+            written.add(path)
+        except FuseOSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            errors += 1
+
+    # local edits going up
+    start = perf_counter()
+    fs._sync()
+    upload_sec = perf_counter() - start
+
+    # edits from another client coming down
+    touched = rand.sample(uuids, min(args.remote_changes, len(uuids)))
+    server.touch(touched)
+    start = perf_counter()
+    fs._sync()
+    download_sec = perf_counter() - start
+
+    sn_api.encryption_helper.shutdown()
+    metrics = fs.item_manager.sync_metrics
+
+    return dict(
+        notes=args.notes,
+        note_bytes=args.note_bytes,
+        latency_sec=args.latency,
+        populate_sec=round(populate_sec, 3),
+        mount_sec=round(mount_sec, 3),
+        mount_requests=requests,
+        mount_items_per_sec=round((args.notes + args.tags) / mount_sec, 1),
+        operations={name: summarize(times) for name, times in latency.items()},
+        sync_upload=dict(items=len(written), seconds=round(upload_sec, 3),
+                         items_per_sec=round(len(written) / upload_sec, 1)),
+        sync_download=dict(items=len(touched), seconds=round(download_sec, 3),
+                           items_per_sec=round(len(touched) / download_sec, 1)),
+        conflicts=metrics['conflicts'],
+        dirty_after_sync=len(fs.item_manager.dirty),
+        write_errors=errors,
+        requests=server.requests,
+        bytes_transferred=server.bytes_transferred,
+    )
+
+def print_report(result):
+    print('notes %d x %d bytes, server latency %.3f s' % (result['notes'],
+          result['note_bytes'], result['latency_sec']))
+    print('mount            %9.3f s  %d requests  %.1f items/s' % (
+          result['mount_sec'], result['mount_requests'],
+          result['mount_items_per_sec']))
+
+    print('\n%-12s %8s %10s %10s %10s %10s' % ('operation', 'ops', 'p50 ms',
+                                             'p90 ms', 'p99 ms', 'max ms'))
+    for name, stats in result['operations'].items():
+        if not stats['ops']:
+            continue
+        print('%-12s %8d %10.3f %10.3f %10.3f %10.3f' % (name, stats['ops'],
+              stats['p50_ms'], stats['p90_ms'], stats['p99_ms'], stats['max_ms']))
+
+    print()
+    for name in ['sync_upload', 'sync_download']:
+        sync = result[name]
+        print('%-16s %9.3f s  %d items  %.1f items/s' % (name, sync['seconds'],
+              sync['items'], sync['items_per_sec']))
+    print('conflicts %d, still dirty %d, %d requests, %.1f MB of JSON' % (
+          result['conflicts'], result['dirty_after_sync'], result['requests'],
+          result['bytes_transferred'] / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=10000)
+    parser.add_argument('--note-bytes', type=int, default=1024)
+    parser.add_argument('--titles', type=int,
+                        help='distinct titles, fewer than notes makes duplicates')
+    parser.add_argument('--tags', type=int, default=10)
+    parser.add_argument('--tagged', type=int, default=100,
+                        help='notes referenced by every tag')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='fake sync server latency per request in seconds')
+    parser.add_argument('--conflict-rate', type=float, default=0.0,
+                        help='chance a saved item conflicts with another client')
+    parser.add_argument('--page-size', type=int, default=150)
+    parser.add_argument('--crypto-workers', type=int, default=1)
+    parser.add_argument('--pw-cost', type=int, default=1000)
+    parser.add_argument('--sync-sec', type=int, default=30)
+    parser.add_argument('--ops', type=int, default=2000,
+                        help='stat and read operations')
+    parser.add_argument('--readdir-ops', type=int, default=20)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--remote-changes', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print JSON only')
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        print_report(result)
+
+if __name__ == '__main__':
+    main()
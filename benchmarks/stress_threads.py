@@ -0,0 +1,178 @@
+# Hammers one ItemManager from reader, writer and sync threads at once, while
+# a second client touches the same notes, and checks its indexes still agree
+# with the items and that none of its edits were lost afterwards.
+#
+#   python benchmarks/stress_threads.py --seconds 10 --readers 8
+
+import argparse
+import os
+import random
+import sys
+from threading import Event, Lock, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_server import FakeSyncServer, connect
+from standardnotes_fs import itemmanager
+from standardnotes_fs.itemmanager import ItemManager
+
+EMAIL = 'stress@example.com'
+PASSWORD = 'stress'
+
+def make_manager(latency):
+    server = FakeSyncServer(latency)
+    server.register(EMAIL, PASSWORD)
+    return ItemManager(connect(server, EMAIL, PASSWORD), '.txt')
+
+def run(args):
+    manager = make_manager(args.latency)
+    for i in range(args.notes):
+        manager.create_note('note %d' % i, 'text %d\n' % i)
+    manager.sync_items()
+
+    # another client of the same account, its changes come back to the
+    # manager in retrieved items and conflicts while it's editing
+    server = manager.sn_api.api
+    other = ItemManager(connect(server, EMAIL, PASSWORD), '.txt')
+    # conflicts are the point here, don't spend the run backing off from them
+    itemmanager.CONFLICT_BACKOFF_SEC = 0.01
+
+    stop = Event()
+    errors = []
+    ops = dict(read=0, write=0, sync=0, other=0)
+    ops_lock = Lock()
+
+    # uuid -> the last text written to it here
+    written = {}
+    written_lock = Lock()
+
+    def worker(kind, step):
+        done = 0
+        while not stop.is_set():
+            try:
+                step()
+                done += 1
+            except KeyError:
+                pass # the note was renamed or deleted under us, like ENOENT
+            except Exception as e:
+                errors.append(repr(e))
+                stop.set()
+        with ops_lock:
+            ops[kind] += done
+
+    def read_step():
+        titles = manager.get_notes() + manager.get_notes(trashed=True)
+        if not titles:
+            return
+        title = random.choice(titles)
+        manager.has_note(title)
+        manager.get_stat(manager.get_note_uuid(title))
+        manager.get_note(title)
+        for tag in manager.get_tags().values():
+            manager.get_tag_notes(tag)
+
+    def write_step():
+        choice = random.random()
+        # conflicted copies hold the edits the other client overwrote, they
+        # have to survive for the check at the end
+        titles = [title for title in manager.get_notes()
+                  if 'CONFLICTED COPY' not in title]
+        if choice < 0.1 or not titles:
+            manager.create_note('new %f' % random.random(), 'new')
+            return
+        uuid = manager.get_note_uuid(random.choice(titles))
+        if choice < 0.6:
+            text = os.urandom(8).hex().encode()
+            with written_lock:
+                manager.write_note(uuid, text)
+                written[uuid] = text.decode()
+        elif choice < 0.8:
+            manager.touch_note(uuid)
+        elif choice < 0.9:
+            manager.delete_note(uuid)
+        else:
+            tags = list(manager.get_tags().values())
+            if tags:
+                manager.tag_note(random.choice(tags), uuid)
+            else:
+                manager.create_tag('tag %f' % random.random())
+
+    def sync_step():
+        manager.sync_items()
+
+    def other_step():
+        titles = other.get_notes()
+        if titles:
+            other.touch_note(other.get_note_uuid(random.choice(titles)))
+        other.sync_items()
+
+    threads = [Thread(target=worker, args=('read', read_step))
+               for _ in range(args.readers)]
+    threads += [Thread(target=worker, args=('write', write_step))
+                for _ in range(args.writers)]
+    threads.append(Thread(target=worker, args=('sync', sync_step)))
+    threads.append(Thread(target=worker, args=('other', other_step)))
+
+    for thread in threads:
+        thread.start()
+    stop.wait(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # conflicts are settled over a few rounds, the other client's copies
+    # have to reach the manager too
+    for _ in range(3):
+        other.sync_items()
+        manager.sync_items()
+
+    # every live note must be in exactly one folder and match its title
+    with manager.lock.read():
+        for title, uuid in manager.note_uuids.items():
+            views = [name for name, notes in manager.views.items() if uuid in notes]
+            if len(views) != 1:
+                errors.append('%s is in folders %s' % (title, views))
+            if manager.note_titles.get(uuid) != title:
+                errors.append('%s has a stale title' % title)
+        if manager.dirty:
+            errors.append('%d items still dirty after the last sync' % len(manager.dirty))
+
+        # no edit may be lost, even one made while its sync was in flight,
+        # the other client's stale copy may win but then it keeps ours as a
+        # conflicted copy
+        helper = manager.sn_api.encryption_helper
+        keys = manager.sn_api.keys
+        server_texts = set()
+        for seq, item in server.items.values():
+            if item['deleted'] or item['content_type'] != 'Note':
+                continue
+            text = helper.decrypt_item(item, keys)['content']['text']
+            server_texts.add(text)
+            if item['uuid'] in manager.items and text != manager.get_text(item['uuid']):
+                errors.append('%s differs from the server' % item['uuid'])
+
+        for uuid, text in written.items():
+            if not server.items[uuid][1]['deleted'] and text not in server_texts:
+                errors.append('%s lost the edit %s' % (uuid, text))
+
+    print('ops:', ops)
+    if errors:
+        print('FAILED:')
+        for error in errors[:20]:
+            print('  ' + error)
+        return 1
+    print('OK')
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--notes', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='fake sync server latency in seconds')
+    sys.exit(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
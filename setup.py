@@ -31,6 +31,9 @@ setuptools.setup(
         'pycryptodome',
         'requests',
     ],
+    extras_require={
+        'openssl': ['cryptography'],
+    },
     python_requires='>=3',
     packages=setuptools.find_packages(),
     classifiers=(
@@ -1,41 +1,106 @@
+import gzip
+import hashlib
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import sys
 import logging
+from time import monotonic
 
-from standardnotes_fs.crypt import EncryptionHelper
+from standardnotes_fs import metrics
+from standardnotes_fs.cache import ItemCache
+from standardnotes_fs.crypt import DEFAULT_WORKERS, EncryptionHelper
+from standardnotes_fs.crypt_backends import DEFAULT_BACKEND
+from standardnotes_fs.trace import debug_enabled, trace, trace_enabled
 
 ALLOWED_ITEM_TYPES = ['Note', 'Tag']
+DEFAULT_TIMEOUT = 60
+DEFAULT_POOL_SIZE = 2
+GZIP_MIN_BYTES = 1024
+DEFAULT_PAGE_SIZE = 150
 
 class SNAPIException(Exception):
     pass
 
+def item_fingerprint(item):
+    # changes whenever the server's copy of an item does
+    fields = [item.get('content') or '', item.get('enc_item_key') or '',
+              item.get('updated_at') or '']
+    return hashlib.blake2b('\0'.join(fields).encode(), digest_size=16).digest()
+
 class RESTAPI:
-    def __init__(self, base_url):
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, compress=False):
         self.base_url = base_url
         self.headers = {}
+        self.timeout = timeout
+        self.compress = compress
+
+        # reuse connections between syncs instead of a handshake every time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
 
     def get(self, route, params=None):
         url = self.base_url + route
-        return requests.get(url, params, headers=self.headers).json()
+        res = self.session.get(url, params=params, headers=self.headers,
+                               timeout=self.timeout)
+        metrics.inc('snfs_http_requests_total', route=route,
+                    status=res.status_code)
+        return res.json()
 
     def post(self, route, data=None):
         url = self.base_url + route
 
-        logging.debug('POST json: ' + json.dumps(data, indent=4))
+        # pretty printing whole syncs is expensive, only do it when shown
+        if debug_enabled():
+            logging.debug('POST json: ' + json.dumps(data, indent=4))
+
+        start = monotonic()
+        body = json.dumps(data).encode()
+        json_size = len(body)
+        headers = dict(self.headers)
+        headers['Content-Type'] = 'application/json'
+        if self.compress and len(body) >= GZIP_MIN_BYTES:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
 
-        res = requests.post(url, data=data, headers=self.headers)
+        res = self.session.post(url, data=body, headers=headers,
+                                timeout=self.timeout)
 
         # res.json() will fail if the response is empty/invalid JSON
         try:
-            logging.debug('Response json: ' + json.dumps(res.json(), indent=4))
-            return res.json()
+            response = res.json()
         except json.decoder.JSONDecodeError:
-            return None
+            response = None
+
+        elapsed = monotonic() - start
+        received = int(res.headers.get('Content-Length') or len(res.content))
+        metrics.inc('snfs_http_requests_total', route=route,
+                    status=res.status_code)
+        metrics.inc('snfs_http_sent_bytes_total', len(body))
+        metrics.inc('snfs_http_received_bytes_total', received)
+        if route == '/items/sync':
+            metrics.observe('snfs_sync_phase_seconds', elapsed, phase='http')
+
+        if trace_enabled():
+            trace('http_post', route=route, status=res.status_code,
+                  json_sent=json_size, sent=len(body), received=received,
+                  json_received=len(res.content),
+                  ms=round(elapsed * 1000, 2))
+        if debug_enabled():
+            logging.debug('Response json: ' + json.dumps(response, indent=4))
+
+        return response
 
     def add_header(self, header):
         self.headers.update(header)
 
+    def close(self):
+        self.session.close()
+
 class StandardNotesAPI:
     encryption_helper = EncryptionHelper()
     sync_token = None
@@ -119,43 +184,148 @@ class StandardNotesAPI:
 
         return self.keys
 
+    def load_cache(self):
+        account = self.username + '@' + self.api.base_url
+        if not self.cache.check_account(account, self.keys):
+            return
+
+        self.sync_token = self.cache.get_sync_token()
+        logging.info('Loading items from the item cache.')
+
+        for cached_items in self.cache.get_items():
+            self.remember_items(cached_items)
+            yield self.encryption_helper.decrypt_response_items(
+                    cached_items, self.keys)
+
+    def load_cached_item(self, uuid):
+        item = self.cache.get_item(uuid)
+        if item is None:
+            return None
+        return self.encryption_helper.decrypt_item(item, self.keys)
+
     def sync(self, dirty_items):
         items = self.handle_dirty_items(dirty_items)
-        data = dict(
-            sync_token=self.sync_token,
-            items=items,
-            api='20190520',
-        )
-        response = self.api.post('/items/sync', data)
+        sync_token = self.sync_token
+        cursor_token = None
+
+        # yield one page at a time so only a page is ever held in memory
+        while True:
+            data = dict(
+                sync_token=sync_token,
+                items=items,
+                limit=self.page_size,
+                api='20190520',
+            )
+            if cursor_token:
+                data['cursor_token'] = cursor_token
+            response = self.api.post('/items/sync', data)
+
+            if not response:
+                raise SNAPIException('Error accessing the Standard Notes API.')
+
+            sync_token = response['sync_token']
+            cursor_token = response.get('cursor_token')
+
+            # only remember the token once every page has been retrieved
+            if not cursor_token:
+                self.sync_token = sync_token
+            self.update_cache(items, response)
 
-        if not response:
-            raise SNAPIException('Error accessing the Standard Notes API.')
+            yield self.handle_response_items(response, items)
+            trace('sync_page', sent_items=len(items),
+                  retrieved=len(response['retrieved_items']),
+                  saved=len(response['saved_items']),
+                  conflicts=len(response['conflicts']),
+                  more=bool(cursor_token))
 
-        self.sync_token = response['sync_token']
-        return self.handle_response_items(response)
+            if not cursor_token:
+                break
+            items = []
+
+    def update_cache(self, sent_items, response):
+        valid_items = [item for item in response['retrieved_items']
+            if item['content_type'] in ALLOWED_ITEM_TYPES]
+        sync_conflicts = [x['server_item'] for x in response['conflicts']
+            if x['type'] == 'sync_conflict']
+        sync_token = None if response.get('cursor_token') else self.sync_token
+        self.cache.update(sync_token, sent_items, valid_items,
+                          response['saved_items'], sync_conflicts)
 
     def handle_dirty_items(self, dirty_items):
         items = self.encryption_helper.encrypt_dirty_items(
                 dirty_items, self.keys)
         return items
 
-    def handle_response_items(self, response):
+    def remember_items(self, items):
+        for item in items:
+            if item.get('deleted', False):
+                self.fingerprints.pop(item['uuid'], None)
+            else:
+                self.fingerprints[item['uuid']] = item_fingerprint(item)
+
+    def handle_response_items(self, response, sent_items):
         valid_items = [item for item in response['retrieved_items']
             if item['content_type'] in ALLOWED_ITEM_TYPES]
+
+        # items we already hold the same ciphertext for don't need remapping
+        changed_items = [item for item in valid_items
+            if self.fingerprints.get(item['uuid']) != item_fingerprint(item)]
+        if len(changed_items) < len(valid_items):
+            trace('unchanged_items', items=len(valid_items) - len(changed_items))
+        self.remember_items(changed_items)
+
         response_items = self.encryption_helper.decrypt_response_items(
-                valid_items, self.keys)
+                changed_items, self.keys)
         saved_items = self.encryption_helper.decrypt_response_items(
                 response['saved_items'], self.keys)
+
+        # what we sent is now the server's copy, under its new updated_at
+        sent_items = {item['uuid']: item for item in sent_items}
+        for item in response['saved_items']:
+            sent = sent_items.get(item['uuid'])
+            if sent is not None and not item.get('deleted', False):
+                item = dict(sent, updated_at=item.get('updated_at'))
+            self.remember_items([item])
+
         sync_conflicts = [x['server_item'] for x in response['conflicts']
             if x['type'] == 'sync_conflict']
+
+        # a server copy we already hold has nothing to keep, the local edit
+        # only has to go up again over its updated_at
+        changed_conflicts = []
+        known_conflicts = []
+        for item in sync_conflicts:
+            if self.fingerprints.get(item['uuid']) == item_fingerprint(item):
+                known_conflicts.append(dict(uuid=item['uuid'],
+                                            updated_at=item.get('updated_at')))
+            else:
+                changed_conflicts.append(item)
         conflicts = self.encryption_helper.decrypt_response_items(
-                sync_conflicts, self.keys)
+                changed_conflicts, self.keys)
+
+        # the local copy keeps our content, so it matches neither version
+        for item in sync_conflicts:
+            self.fingerprints.pop(item['uuid'], None)
+
         return dict(
             response_items=response_items,
             saved_items=saved_items,
             conflicts=conflicts,
+            known_conflicts=known_conflicts,
         )
 
-    def __init__(self, base_url, username):
-        self.api = RESTAPI(base_url)
+    def __init__(self, base_url, username, cache=None, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, compress=False,
+                 page_size=DEFAULT_PAGE_SIZE, crypto_workers=DEFAULT_WORKERS,
+                 crypto_backend=DEFAULT_BACKEND):
+        self.api = RESTAPI(base_url, timeout, pool_size, compress)
+        self.encryption_helper = EncryptionHelper(crypto_workers,
+                                                  backend=crypto_backend)
+        self.page_size = page_size
         self.username = username
+
+        # uuid -> fingerprint of the server copy our local item was mapped from
+        self.fingerprints = {}
+
+        # without a cache file the ciphertext is still kept, just in memory
+        self.cache = cache if cache else ItemCache()
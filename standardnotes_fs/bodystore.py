@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_BUDGET_MB = 64
+
+class NoteBodyStore:
+    def _evict(self):
+        # always keep the most recent body, even if it's over budget alone
+        while self.size > self.budget and len(self.bodies) > 1:
+            uuid, text = self.bodies.popitem(last=False)
+            self.size -= len(text)
+
+    def _remove(self, uuid):
+        text = self.bodies.pop(uuid, None)
+        if text is not None:
+            self.size -= len(text)
+        self.pinned.pop(uuid, None)
+
+    def get(self, uuid):
+        with self.lock:
+            if uuid in self.pinned:
+                return self.pinned[uuid]
+
+            text = self.bodies.get(uuid)
+            if text is not None:
+                self.bodies.move_to_end(uuid)
+            return text
+
+    def put(self, uuid, text, pinned=False):
+        with self.lock:
+            self._remove(uuid)
+
+            # pinned bodies have no ciphertext to reload them from yet
+            if pinned:
+                self.pinned[uuid] = text
+            else:
+                self.bodies[uuid] = text
+                self.size += len(text)
+                self._evict()
+
+    def unpin(self, uuid):
+        with self.lock:
+            text = self.pinned.pop(uuid, None)
+            if text is not None:
+                self.bodies[uuid] = text
+                self.size += len(text)
+                self._evict()
+
+    def discard(self, uuid):
+        with self.lock:
+            self._remove(uuid)
+
+    def __init__(self, budget_mb=DEFAULT_BUDGET_MB):
+        self.budget = budget_mb * 1024 * 1024
+        self.size = 0
+        self.bodies = OrderedDict()
+        self.pinned = {}
+        self.lock = Lock()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+CACHE_VERSION = '1'
+DATA_KEYS = ['content', 'enc_item_key', 'auth_hash']
+BATCH_SIZE = 500
+
+class ItemCache:
+    def _open(self):
+        if self.path != ':memory:':
+            # create the file ourselves so it's never world readable
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            os.close(fd)
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS items '
+                        '(uuid TEXT PRIMARY KEY, item TEXT)')
+        self.db.commit()
+
+    def _reset(self):
+        with self.db:
+            self.db.execute('DELETE FROM meta')
+            self.db.execute('DELETE FROM items')
+            self.db.execute('INSERT INTO meta VALUES (?, ?)',
+                            ('version', CACHE_VERSION))
+
+    def _get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def check_account(self, account, keys):
+        # a cache from another account or an old password can't be decrypted
+        key_check = hashlib.sha256(('snfs-cache:' + keys['ak']).encode()).hexdigest()
+        account = json.dumps([account, key_check])
+
+        with self.lock:
+            if (self._get_meta('version') == CACHE_VERSION
+                and self._get_meta('account') == account):
+                return True
+
+            logging.info('Item cache is empty or stale, starting fresh.')
+            self._reset()
+            with self.db:
+                self.db.execute('INSERT INTO meta VALUES (?, ?)',
+                                ('account', account))
+            return False
+
+    def get_sync_token(self):
+        with self.lock:
+            return self._get_meta('sync_token')
+
+    def get_item(self, uuid):
+        with self.lock:
+            row = self.db.execute('SELECT item FROM items WHERE uuid = ?',
+                                  (uuid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_items(self, batch_size=BATCH_SIZE):
+        with self.lock:
+            cursor = self.db.execute('SELECT item FROM items ORDER BY '
+                                     'json_extract(item, \'$.created_at\')')
+
+        # only a batch of rows is read and decoded at a time, sqlite does the
+        # sorting and spills it to disk for big accounts
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield [json.loads(row[0]) for row in rows]
+
+    def update(self, sync_token, sent_items, retrieved_items, saved_items,
+               conflicts):
+        sent_items = {item['uuid']: item for item in sent_items}
+        puts = []
+        deletes = []
+
+        def store(item):
+            if item.get('deleted', False):
+                deletes.append((item['uuid'],))
+            else:
+                puts.append((item['uuid'], json.dumps(item)))
+
+        for item in retrieved_items:
+            store(item)
+
+        # saved items come back without their content, so merge in what we sent
+        for item in saved_items:
+            sent = sent_items.get(item['uuid'])
+            if sent is None:
+                continue
+            merged = dict(sent)
+            merged.update((k, v) for k, v in item.items() if k not in DATA_KEYS)
+            store(merged)
+
+        for item in conflicts:
+            store(item)
+
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM items WHERE uuid = ?', deletes)
+            self.db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?)', puts)
+            if sync_token is not None:
+                self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                ('sync_token', sync_token))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def __init__(self, path=None):
+        self.path = str(path) if path else ':memory:'
+        self.lock = Lock()
+
+        try:
+            self._open()
+        except sqlite3.DatabaseError:
+            logging.error('Item cache "%s" is corrupt, recreating it.' % self.path)
+            os.unlink(self.path)
+            self._open()
@@ -1,17 +1,25 @@
 from base64 import b64decode, b64encode
 from binascii import hexlify, unhexlify
-from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import hashlib
 import hmac
+from itertools import repeat
 import json
 import logging
+import multiprocessing
+import os
 import sys
+from threading import Lock
+from time import monotonic
 
-from Crypto.Cipher import AES
-from Crypto.Random import random
-from Crypto.Util import Padding
+from standardnotes_fs import metrics
+from standardnotes_fs.crypt_backends import DEFAULT_BACKEND, get_backend
+from standardnotes_fs.trace import trace
 
 BITS_PER_HEX_DIGIT = 4
+BITS_PER_BYTE = 8
 
 PASS_KEY_LEN = 96
 AES_KEY_LEN = 256
@@ -19,7 +27,127 @@ AES_STR_KEY_LEN = AES_KEY_LEN // BITS_PER_HEX_DIGIT
 AES_IV_LEN = 128
 AES_STR_IV_LEN = AES_IV_LEN // BITS_PER_HEX_DIGIT
 
+DEFAULT_WORKERS = 1
+PARALLEL_MIN_ITEMS = 32
+CHUNKS_PER_WORKER = 4
+ITEM_KEY_CACHE_SIZE = 20000
+
 class EncryptionHelper:
+    executor = None
+    executor_pid = None
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 item_key_cache_size=ITEM_KEY_CACHE_SIZE,
+                 backend=DEFAULT_BACKEND):
+        self.workers = workers
+        self.backend = get_backend(backend)
+        self.item_key_cache_size = item_key_cache_size
+        self._init_caches()
+
+    def _init_caches(self):
+        self.master_keys = None
+        self.item_keys = OrderedDict()
+        self.cache_lock = Lock()
+
+    def __getstate__(self):
+        # the pool can't be sent to its own workers, and the caches are
+        # per process (HMAC objects and locks can't be pickled anyway)
+        state = self.__dict__.copy()
+        for key in ['executor', 'master_keys', 'item_keys', 'cache_lock']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_caches()
+
+    def _prepare_keys(self, encryption_key, auth_key):
+        # decoded AES key and an HMAC already keyed, copied for each use
+        return unhexlify(encryption_key), hmac.new(unhexlify(auth_key),
+                                                   digestmod='sha256')
+
+    def _get_master_keys(self, keys):
+        master_keys = self.master_keys
+        if master_keys is None or master_keys[0] != (keys['mk'], keys['ak']):
+            prepared = self._prepare_keys(keys['mk'], keys['ak'])
+            master_keys = ((keys['mk'], keys['ak']), prepared)
+            with self.cache_lock:
+                self.master_keys = master_keys
+                self.item_keys.clear()
+        return master_keys[1]
+
+    def _item_key_id(self, uuid, enc_item_key):
+        return hashlib.blake2b((uuid + ':' + enc_item_key).encode(),
+                               digest_size=16).digest()
+
+    def _get_item_key(self, key_id):
+        with self.cache_lock:
+            item_key = self.item_keys.get(key_id)
+            if item_key is not None:
+                self.item_keys.move_to_end(key_id)
+            return item_key
+
+    def _put_item_key(self, key_id, item_key):
+        with self.cache_lock:
+            self.item_keys[key_id] = item_key
+            while len(self.item_keys) > self.item_key_cache_size:
+                self.item_keys.popitem(last=False)
+
+    def _get_executor(self):
+        # a pool inherited across a fork belongs to the parent process
+        if self.executor and self.executor_pid != os.getpid():
+            self.executor = None
+
+        if not self.executor:
+            # don't fork workers from a process that's running other threads,
+            # and not from a forkserver either, the one started before FUSE
+            # daemonizes can't be used by the daemon
+            self.executor = ProcessPoolExecutor(self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            self.executor_pid = os.getpid()
+
+        return self.executor
+
+    def shutdown(self):
+        if self.executor and self.executor_pid == os.getpid():
+            try:
+                self.executor.shutdown()
+            except (BrokenProcessPool, OSError):
+                pass
+        self.executor = None
+
+    def _map_parallel(self, func, items, keys):
+        chunksize = -(-len(items) // (self.workers * CHUNKS_PER_WORKER))
+        try:
+            executor = self._get_executor()
+
+            # map() keeps the order and re-raises a worker's SystemExit here
+            return list(executor.map(func, items, repeat(keys),
+                                     chunksize=chunksize))
+        except (BrokenProcessPool, OSError) as e:
+            # a sync is worth more than the speed up, so stay serial
+            logging.error('Crypto workers failed (%r), continuing without them.'
+                          % e)
+            self.shutdown()
+            self.workers = 1
+            return [func(item, keys) for item in items]
+
+    def _map_items(self, func, items, keys):
+        start = monotonic()
+
+        if self.workers < 2 or len(items) < PARALLEL_MIN_ITEMS:
+            results = [func(item, keys) for item in items]
+        else:
+            results = self._map_parallel(func, items, keys)
+
+        if items:
+            elapsed = monotonic() - start
+            phase = func.__name__[:-len('_item')]
+            metrics.observe('snfs_sync_phase_seconds', elapsed, phase=phase)
+            metrics.inc('snfs_crypto_items_total', len(items), op=phase)
+            trace(func.__name__, items=len(items), ms=round(elapsed * 1000, 2))
+        return results
+
     def generate_salt_from_nonce(self, email, version, pw_cost, pw_nonce):
         string_to_hash = ':'.join([email, 'SF', version, pw_cost, pw_nonce])
         output = hashlib.sha256(string_to_hash.encode()).hexdigest()
@@ -41,29 +169,34 @@ class EncryptionHelper:
         return dict(pw=pw, mk=mk, ak=ak)
 
     def encrypt_dirty_items(self, dirty_items, keys):
-        return [self.encrypt_item(item, keys) for item in dirty_items]
+        return self._map_items(self.encrypt_item, dirty_items, keys)
 
     def decrypt_response_items(self, response_items, keys):
-        return [self.decrypt_item(item, keys) for item in response_items]
+        return self._map_items(self.decrypt_item, response_items, keys)
 
     def encrypt_item(self, item, keys):
         uuid = item['uuid']
         content = json.dumps(item['content'])
 
-        logging.debug('Encrypting item {} with content: {}'.format(uuid, content))
+        logging.debug('Encrypting item %s with content: %s', uuid, content)
 
         # all this is to follow the Standard Notes spec
-        item_key = hex(random.getrandbits(AES_KEY_LEN * 2))
-        # remove '0x', pad with 0's, then split in half
-        item_key = item_key[2:].rjust(AES_STR_KEY_LEN * 2, '0')
+        item_key = self.random_hex(AES_KEY_LEN * 2)
         item_ek = item_key[:AES_STR_KEY_LEN]
         item_ak = item_key[AES_STR_KEY_LEN:]
 
-        enc_item = deepcopy(item)
+        master_keys = self._get_master_keys(keys)
+
+        # shallow, the keys that change are replaced rather than modified
+        enc_item = dict(item)
         enc_item['content'] = self.encrypt_string_003(
                 content, item_ek, item_ak, uuid)
-        enc_item['enc_item_key'] = self.encrypt_string_003(
-                item_key, keys['mk'], keys['ak'], uuid)
+        enc_item['enc_item_key'] = self._encrypt_003(
+                item_key, *master_keys, uuid)
+
+        # the server sends this back, no need to unwrap it again then
+        self._put_item_key(self._item_key_id(uuid, enc_item['enc_item_key']),
+                           item_key)
 
         return enc_item
 
@@ -76,7 +209,8 @@ class EncryptionHelper:
         enc_item_key = item['enc_item_key']
         version = content[:3]
 
-        logging.debug('Decrypting item {} of version {} with content: {}'.format(uuid, version, content))
+        logging.debug('Decrypting item %s of version %s with content: %s',
+                      uuid, version, content)
 
         if version == '001' or version == '002':
             print('Old encryption protocol detected. This version is not '
@@ -85,8 +219,16 @@ class EncryptionHelper:
                   'https://standardnotes.org/help/resync')
             sys.exit(1)
         elif version == '003':
-            item_key = self.decrypt_string_003(
-                    enc_item_key, keys['mk'], keys['ak'], uuid)
+            master_keys = self._get_master_keys(keys)
+
+            # the item key only changes when the item is re-encrypted
+            key_id = self._item_key_id(uuid, enc_item_key)
+            item_key = self._get_item_key(key_id)
+            if item_key is None:
+                item_key = self._decrypt_003(
+                        enc_item_key, *master_keys, uuid)
+                self._put_item_key(key_id, item_key)
+
             item_key_length = len(item_key)
             item_ek = item_key[:item_key_length//2]
             item_ak = item_key[item_key_length//2:]
@@ -98,32 +240,41 @@ class EncryptionHelper:
                   'that something is wrong with the server. Exiting.')
             sys.exit(1)
 
-        dec_item = deepcopy(item)
+        dec_item = dict(item)
         dec_item['content'] = json.loads(dec_content)
 
         return dec_item
 
+    def random_hex(self, bits):
+        return hexlify(self.backend.random_bytes(bits // BITS_PER_BYTE)).decode()
+
     def encrypt_string_003(self, string_to_encrypt, encryption_key,
                                 auth_key, uuid):
-        IV = hex(random.getrandbits(AES_IV_LEN))
-        IV = IV[2:].rjust(AES_STR_IV_LEN, '0') # remove '0x', pad with 0's
+        return self._encrypt_003(string_to_encrypt,
+                *self._prepare_keys(encryption_key, auth_key), uuid)
+
+    def decrypt_string_003(self, string_to_decrypt, encryption_key,
+                                auth_key, uuid):
+        return self._decrypt_003(string_to_decrypt,
+                *self._prepare_keys(encryption_key, auth_key), uuid)
+
+    def _encrypt_003(self, string_to_encrypt, encryption_key, auth_hmac, uuid):
+        IV = self.random_hex(AES_IV_LEN)
 
-        cipher = AES.new(unhexlify(encryption_key), AES.MODE_CBC, unhexlify(IV))
         pt = string_to_encrypt.encode()
-        padded_pt = Padding.pad(pt, AES.block_size)
-        ciphertext = b64encode(cipher.encrypt(padded_pt)).decode()
+        ciphertext = self.backend.encrypt(encryption_key, unhexlify(IV), pt)
+        ciphertext = b64encode(ciphertext).decode()
 
         string_to_auth = ':'.join(['003', uuid, IV, ciphertext])
-        auth_hash = hmac.new(
-                unhexlify(auth_key), string_to_auth.encode(), 'sha256').digest()
-        auth_hash = hexlify(auth_hash).decode()
+        auth_hash = auth_hmac.copy()
+        auth_hash.update(string_to_auth.encode())
+        auth_hash = auth_hash.hexdigest()
 
         result = ':'.join(['003', auth_hash, uuid, IV, ciphertext])
 
         return result
 
-    def decrypt_string_003(self, string_to_decrypt, encryption_key,
-                                auth_key, uuid):
+    def _decrypt_003(self, string_to_decrypt, encryption_key, auth_hmac, uuid):
         components = string_to_decrypt.split(':')
         if len(components) == 6:
             version, auth_hash, local_uuid, IV, ciphertext, auth_params = components
@@ -139,8 +290,9 @@ class EncryptionHelper:
             sys.exit(1)
 
         string_to_auth = ':'.join([version, uuid, IV, ciphertext])
-        local_auth_hash = hmac.new(
-                unhexlify(auth_key), string_to_auth.encode(), 'sha256').digest()
+        local_auth_hash = auth_hmac.copy()
+        local_auth_hash.update(string_to_auth.encode())
+        local_auth_hash = local_auth_hash.digest()
 
         auth_hash = unhexlify(auth_hash)
         if not hmac.compare_digest(local_auth_hash, auth_hash):
@@ -149,8 +301,8 @@ class EncryptionHelper:
             logging.debug('Auth Hash: {}, Local Auth Hash: {}'.format(auth_hash, local_auth_hash))
             sys.exit(1)
 
-        cipher = AES.new(unhexlify(encryption_key), AES.MODE_CBC, unhexlify(IV))
-        result = cipher.decrypt(b64decode(ciphertext))
-        result = Padding.unpad(result, AES.block_size).decode()
+        result = self.backend.decrypt(encryption_key, unhexlify(IV),
+                                      b64decode(ciphertext))
+        result = result.decode()
 
         return result
@@ -0,0 +1,80 @@
+from abc import ABC, abstractmethod
+import os
+
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+DEFAULT_BACKEND = 'pycryptodome'
+AES_BLOCK_BITS = 128
+
+class CryptoBackend(ABC):
+    # AES-256-CBC with PKCS#7 padding, everything else the 003 spec needs
+    # (HMAC-SHA256, PBKDF2) comes from hashlib which is OpenSSL already
+    name = None
+
+    def random_bytes(self, length):
+        return os.urandom(length)
+
+    @abstractmethod
+    def encrypt(self, key, iv, plaintext):
+        pass
+
+    @abstractmethod
+    def decrypt(self, key, iv, ciphertext):
+        pass
+
+class PyCryptodomeBackend(CryptoBackend):
+    name = 'pycryptodome'
+
+    def encrypt(self, key, iv, plaintext):
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        return cipher.encrypt(Padding.pad(plaintext, AES.block_size))
+
+    def decrypt(self, key, iv, ciphertext):
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        return Padding.unpad(cipher.decrypt(ciphertext), AES.block_size)
+
+class OpenSSLBackend(CryptoBackend):
+    name = 'openssl'
+
+    def encrypt(self, key, iv, plaintext):
+        padder = padding.PKCS7(AES_BLOCK_BITS).padder()
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+        padded = padder.update(plaintext) + padder.finalize()
+        return encryptor.update(padded) + encryptor.finalize()
+
+    def decrypt(self, key, iv, ciphertext):
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+        unpadder = padding.PKCS7(AES_BLOCK_BITS).unpadder()
+        padded = decryptor.update(ciphertext) + decryptor.finalize()
+
+        # match pycryptodome, which raises ValueError for bad padding
+        try:
+            return unpadder.update(padded) + unpadder.finalize()
+        except ValueError:
+            raise ValueError('Padding is incorrect.')
+
+BACKENDS = [PyCryptodomeBackend, OpenSSLBackend]
+
+def available_backends():
+    names = [PyCryptodomeBackend.name]
+    if Cipher is not None:
+        names.append(OpenSSLBackend.name)
+    return names
+
+def get_backend(name=DEFAULT_BACKEND):
+    if name not in available_backends():
+        if name in [backend.name for backend in BACKENDS]:
+            raise ValueError('Crypto backend "%s" needs the "cryptography" '
+                             'package to be installed.' % name)
+        raise ValueError('Unknown crypto backend "%s".' % name)
+
+    for backend in BACKENDS:
+        if backend.name == name:
+            return backend()
@@ -0,0 +1,164 @@
+import argparse
+from binascii import unhexlify
+import json
+import sys
+from time import perf_counter
+
+from standardnotes_fs.crypt import AES_KEY_LEN, EncryptionHelper
+from standardnotes_fs.crypt_backends import BACKENDS, available_backends
+
+DEFAULT_ITEMS = 2000
+DEFAULT_NOTE_BYTES = 2048
+DEFAULT_ROUNDS = 3
+
+# AES-256-CBC from NIST SP 800-38A F.2.5, padding only adds a block at the end
+NIST_KEY = '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4'
+NIST_IV = '000102030405060708090a0b0c0d0e0f'
+NIST_PLAINTEXT = ('6bc1bee22e409f96e93d7e117393172aae2d8a571e03ac9c9eb76fac45af8e51'
+                  '30c81c46a35ce411e5fbc1191a0a52eff69f2445df4f9b17ad2b417be66c3710')
+NIST_CIPHERTEXT = ('f58c4c04d6e5f1ba779eabfb5f7bfbd69cfc4e967edb808d679f777bc6702c7d'
+                   '39f23369a9d9bacfa530e26304231461b2eb05e2c39be9fcda6c19078c6a9d1b')
+
+# 003 strings as (plaintext, encryption key, auth key, uuid, IV, result)
+VECTOR_EK = '603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4'
+VECTOR_AK = '2b7e151628aed2a6abf7158809cf4f3c762e7160f38b4da56a784d9045190cfe'
+VECTOR_UUID = '3b2fbc8b-1b8f-4a4b-9d59-5e0a2d1c7d10'
+TEST_VECTORS_003 = [
+    ('', VECTOR_EK, VECTOR_AK, VECTOR_UUID, NIST_IV,
+     '003:c7755225b26688fcfb63d0524164d503acdc02decdbc9d3c77090a8f2c580ba0:'
+     '3b2fbc8b-1b8f-4a4b-9d59-5e0a2d1c7d10:000102030405060708090a0b0c0d0e0f:'
+     'fpJI5dgpynWT8MVJ2y9bjA=='),
+    ('{"title":"Test","text":"Hello, world! ü✓"}',
+     VECTOR_EK, VECTOR_AK, VECTOR_UUID, NIST_IV,
+     '003:947c2070ea88df79577633ed0551e01360a3597f1d8b4bfd595d0ebe5ca02ba1:'
+     '3b2fbc8b-1b8f-4a4b-9d59-5e0a2d1c7d10:000102030405060708090a0b0c0d0e0f:'
+     'pDjYgC6igVF1U/Pz4cdwYlRG6VHBk6pyl2XuGOmPPvAMxWFBsU87CIZfqYx5jmRV'),
+]
+
+def check_backend(name):
+    helper = EncryptionHelper(backend=name)
+    backend = helper.backend
+    failures = []
+
+    key, iv = unhexlify(NIST_KEY), unhexlify(NIST_IV)
+    plaintext = unhexlify(NIST_PLAINTEXT)
+    ciphertext = backend.encrypt(key, iv, plaintext)
+    if ciphertext[:len(plaintext)] != unhexlify(NIST_CIPHERTEXT):
+        failures.append('AES-256-CBC encrypt')
+    if backend.decrypt(key, iv, ciphertext) != plaintext:
+        failures.append('AES-256-CBC decrypt')
+
+    for i, (plaintext, ek, ak, uuid, iv, result) in enumerate(TEST_VECTORS_003):
+        # the IV is the only random part of an encrypted string
+        backend.random_bytes = lambda length: unhexlify(iv)
+        if helper.encrypt_string_003(plaintext, ek, ak, uuid) != result:
+            failures.append('003 encrypt vector %d' % i)
+        if helper.decrypt_string_003(result, ek, ak, uuid) != plaintext:
+            failures.append('003 decrypt vector %d' % i)
+
+    return failures
+
+def make_items(count, note_bytes):
+    text = ('lorem ipsum dolor sit amet ' * (note_bytes // 27 + 1))[:note_bytes]
+    return [dict(uuid='00000000-0000-4000-8000-%012d' % i,
+                 content_type='Note', deleted=False,
+                 created_at='2019-01-01T00:00:00.000Z',
+                 content=dict(title='Note %d' % i, text=text, references=[]))
+            for i in range(count)]
+
+def bench_backend(name, items, rounds, workers):
+    keys = {}
+    helper = EncryptionHelper(workers, backend=name)
+    keys['mk'] = helper.random_hex(AES_KEY_LEN)
+    keys['ak'] = helper.random_hex(AES_KEY_LEN)
+    size = sum(len(json.dumps(item['content'])) for item in items)
+
+    # an untimed round first, so starting the worker pool isn't measured
+    enc_items = helper.encrypt_dirty_items(items, keys)
+    helper.decrypt_response_items(enc_items, keys)
+
+    encrypt_times = []
+    decrypt_times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        enc_items = helper.encrypt_dirty_items(items, keys)
+        encrypt_times.append(perf_counter() - start)
+
+        # forget the item keys, so every one is unwrapped like on a first sync
+        helper.item_keys.clear()
+        start = perf_counter()
+        helper.decrypt_response_items(enc_items, keys)
+        decrypt_times.append(perf_counter() - start)
+    helper.shutdown()
+
+    results = []
+    for op, times in [('encrypt', encrypt_times), ('decrypt', decrypt_times)]:
+        best = min(times)
+        results.append(dict(backend=name, op=op, items=len(items),
+                            seconds=round(best, 4),
+                            items_per_sec=round(len(items) / best, 1),
+                            mb_per_sec=round(size / best / 1e6, 2)))
+    return results
+
+def parse_options(argv):
+    parser = argparse.ArgumentParser(prog='snfs bench-crypto',
+        description='Check each crypto backend against the 003 test vectors '
+                    'and time encrypting and decrypting synthetic notes.')
+    parser.add_argument('--backend', action='append',
+                        choices=[backend.name for backend in BACKENDS],
+                        help='backend to test, can be repeated. Default: all '
+                        'installed backends')
+    parser.add_argument('--items', type=int, default=DEFAULT_ITEMS,
+                        help='notes per round. Default: '+str(DEFAULT_ITEMS))
+    parser.add_argument('--note-bytes', type=int, default=DEFAULT_NOTE_BYTES,
+                        help='text size of each note. Default: '
+                        ''+str(DEFAULT_NOTE_BYTES))
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS,
+                        help='rounds to run, the best is reported. Default: '
+                        ''+str(DEFAULT_ROUNDS))
+    parser.add_argument('--crypto-workers', type=int, default=1,
+                        help='processes used like the mount option. Default: 1')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_options(argv)
+    names = args.backend or available_backends()
+    items = make_items(max(1, args.items), max(0, args.note_bytes))
+    results = []
+    failed = False
+
+    for name in names:
+        if name not in available_backends():
+            print('Skipping %s, the "cryptography" package is not installed.'
+                  % name, file=sys.stderr)
+            continue
+
+        failures = check_backend(name)
+        if failures:
+            print('Backend %s failed: %s' % (name, ', '.join(failures)),
+                  file=sys.stderr)
+            failed = True
+            continue
+
+        results += bench_backend(name, items, max(1, args.rounds),
+                                 max(1, args.crypto_workers))
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+    elif results:
+        print('%-14s %-8s %12s %10s' % ('backend', 'op', 'items/s', 'MB/s'))
+        for result in results:
+            print('%-14s %-8s %12.1f %10.2f' % (result['backend'], result['op'],
+                  result['items_per_sec'], result['mb_per_sec']))
+
+        totals = {}
+        for result in results:
+            totals[result['backend']] = (totals.get(result['backend'], 0)
+                                         + result['seconds'])
+        fastest = min(totals, key=totals.get)
+        print('\nFastest here: --crypto-backend ' + fastest)
+
+    if failed or not results:
+        sys.exit(1)
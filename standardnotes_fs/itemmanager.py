@@ -1,8 +1,54 @@
 from datetime import datetime
-from copy import deepcopy
+import hashlib
+from heapq import heappop, heappush
+from itertools import count
+import json
+import logging
+import re
+import sys
+from threading import Lock
+from time import monotonic, sleep
 from uuid import uuid1
 
+import iso8601
+
+from standardnotes_fs import metrics
 from standardnotes_fs.api import StandardNotesAPI
+from standardnotes_fs.bodystore import DEFAULT_BUDGET_MB, NoteBodyStore
+from standardnotes_fs.rwlock import RWLock, reader, writer
+from standardnotes_fs.trace import trace
+
+MAX_CONFLICT_ROUNDS = 5
+CONFLICT_BACKOFF_SEC = 0.5
+TOKEN_RE = re.compile(r'\w+')
+SMALL_POSTINGS = 8
+
+def tokenize(text):
+    # words are shared by many notes, so keep one copy of each
+    return frozenset(map(sys.intern, set(TOKEN_RE.findall(text.lower()))))
+
+def content_hash(content, text=None):
+    # client_updated_at changes on every local edit, even one that changes
+    # nothing else, so it's left out of the hash
+    content = dict(content)
+    if text is None:
+        text = content.pop('text', '').encode()
+    else:
+        content.pop('text', None)
+
+    app_data = dict(content.pop('appData', {}))
+    ref = dict(app_data.pop('org.standardnotes.sn', {}))
+    ref.pop('client_updated_at', None)
+    if ref:
+        app_data['org.standardnotes.sn'] = ref
+    if app_data:
+        content['appData'] = app_data
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps(content, sort_keys=True).encode())
+    digest.update(b'\0')
+    digest.update(text)
+    return digest.digest()
 
 class ItemManager:
     items = {}
@@ -13,9 +59,50 @@ class ItemManager:
     tag_titles = {}
     ext = ''
 
+    def release_title_slot(self, uuid):
+        slot = self.title_counts.pop(uuid, None)
+        if slot is None:
+            return
+
+        key, number = slot
+        slots = self.title_slots[key]
+        heappush(slots['free'], number)
+        if len(slots['free']) == slots['next']:
+            del self.title_slots[key]
+
+    def take_title_slot(self, key, make_title, uuid_cache):
+        slots = self.title_slots.setdefault(key, dict(next=0, free=[]))
+
+        # lowest number this title isn't using, instead of trying them all
+        while True:
+            if slots['free']:
+                number = heappop(slots['free'])
+            else:
+                number = slots['next']
+                slots['next'] += 1
+
+            title = make_title(number)
+            if title not in uuid_cache:
+                break
+
+            # taken by a different title that happens to match, e.g. "Note2",
+            # so it's only retried once that title goes away
+            self.blocked_titles.setdefault((key[0], title), []).append((key, number))
+
+        return number, title
+
+    def unblock_title(self, content_type, title):
+        for key, number in self.blocked_titles.pop((content_type, title), []):
+            slots = self.title_slots.get(key)
+            if slots:
+                heappush(slots['free'], number)
+
     def cache_item_title(self, item, uuid_cache, title_cache):
         # remove title from caches if it's in there
-        uuid_cache.pop(title_cache.pop(item['uuid'], None), None)
+        old_title = title_cache.pop(item['uuid'], None)
+        uuid_cache.pop(old_title, None)
+        self.release_title_slot(item['uuid'])
+        self.unblock_title(item['content_type'], old_title)
 
         if item.get('deleted', False):
             return
@@ -26,23 +113,23 @@ class ItemManager:
         conflicted = 'conflict_of' in content
 
         # remove title duplicates by adding a number to the end
-        count = 0
-        while True:
-            title = original_title + ('' if not count else str(count + 1)) + (' CONFLICTED COPY' if conflicted else '')
+        def make_title(number):
+            title = original_title + ('' if not number else str(number + 1)) + (' CONFLICTED COPY' if conflicted else '')
 
             # clean up filenames
             title = title.replace('/', '-')
             if content_type == 'Note':
                 title += self.ext
+            return title
 
-            if title in uuid_cache:
-                count += 1
-            else:
-                break
+        key = (content_type, original_title, conflicted)
+        number, title = self.take_title_slot(key, make_title, uuid_cache)
 
+        self.title_counts[item['uuid']] = (key, number)
         uuid_cache[title] = item['uuid']
         title_cache[item['uuid']] = title
 
+    @writer
     def map_items(self, response_items, metadata_only=False):
         DATA_KEYS = ['content', 'enc_item_key', 'auth_hash']
 
@@ -60,47 +147,266 @@ class ItemManager:
             if item['deleted']:
                 if uuid in self.items:
                     del self.items[uuid]
+                self.bodies.discard(uuid)
+                self.padded_notes.discard(uuid)
+                self.body_sizes.pop(uuid, None)
+                self.dirty.pop(uuid, None)
+                self.synced_hashes.pop(uuid, None)
+                self.local_mtimes.pop(uuid, None)
+                self.index_item(uuid)
                 continue
 
-            item['dirty'] = False
+            # the server's copy replaces any local edits
+            if not metadata_only:
+                self.dirty.pop(uuid, None)
+                self.local_mtimes.pop(uuid, None)
 
             if uuid not in self.items:
                 self.items[uuid] = dict(count=self.item_count)
                 self.item_count += 1
 
+            # only metadata stays resident, note bodies go in the body store
+            text = None
+            if item['content_type'] == 'Note' and not metadata_only:
+                content = dict(item['content'])
+                text = content.pop('text', '')
+                data = text.encode()
+                self.store_body(uuid, data)
+                item['content'] = content
+                self.synced_hashes[uuid] = content_hash(content, data)
+            elif not metadata_only:
+                self.synced_hashes[uuid] = content_hash(item['content'])
+
             for key, value in item.items():
                 if metadata_only and key in DATA_KEYS:
                     continue
                 self.items[uuid][key] = value
 
+            self.index_item(uuid, text)
+
+    def index_item(self, uuid, text=None):
+        for notes in self.views.values():
+            notes.discard(uuid)
+        self.tag_notes.pop(uuid, None)
+        self.stats.pop(uuid, None)
+
+        item = self.items.get(uuid)
+        self.index_search(uuid, item, text)
+        if not item:
+            return
+
+        if uuid in self.note_titles:
+            if self.get_trashed(item):
+                self.views['trash'].add(uuid)
+            elif self.get_archived(item):
+                self.views['archived'].add(uuid)
+            else:
+                self.views['notes'].add(uuid)
+        elif uuid in self.tag_titles:
+            references = item['content']['references']
+            self.tag_notes[uuid] = {r['uuid'] for r in references
+                                    if r['content_type'] == 'Note'}
+
+    def index_search(self, uuid, item, text=None):
+        # text is only passed when it changed, without it only a new title
+        # needs the note indexed again
+        if self.search_index is None:
+            return
+
+        old_title = self.search_titles.pop(uuid, None)
+        old_tokens = self.search_tokens.pop(uuid, ())
+        tokens = ()
+        if item and item['content_type'] == 'Note' and not item.get('deleted', False):
+            title = item['content'].get('title', '')
+            if text is None and title == old_title:
+                tokens = old_tokens
+            else:
+                if text is None:
+                    text = self.get_text(uuid)
+                # a sorted tuple is a fraction of the size of a set
+                tokens = tuple(sorted(tokenize(text) | tokenize(title)))
+            self.search_titles[uuid] = title
+            self.search_tokens[uuid] = tokens
+
+        if tokens == old_tokens:
+            return
+        # most words are in a few notes, their uuids are kept in a tuple
+        # until there are enough of them to be worth a set
+        tokens, old_tokens = frozenset(tokens), frozenset(old_tokens)
+        for token in old_tokens - tokens:
+            uuids = self.search_index[token]
+            if isinstance(uuids, set):
+                uuids.discard(uuid)
+            else:
+                uuids = tuple(x for x in uuids if x != uuid)
+                self.search_index[token] = uuids
+            if not uuids:
+                del self.search_index[token]
+        for token in tokens - old_tokens:
+            uuids = self.search_index.get(token, ())
+            if isinstance(uuids, set):
+                uuids.add(uuid)
+            elif len(uuids) < SMALL_POSTINGS:
+                self.search_index[token] = uuids + (uuid,)
+            else:
+                self.search_index[token] = set(uuids)
+                self.search_index[token].add(uuid)
+        self.search_results = None
+
+    @reader
+    def search_notes(self, query):
+        # every word has to match, remembered since ls -l stats each result
+        if self.search_index is None:
+            return set()
+
+        last = self.search_results
+        if last and last[0] == query:
+            uuids = last[1]
+        else:
+            postings = sorted((self.search_index.get(token, ())
+                               for token in tokenize(query)), key=len)
+            uuids = (set(postings[0]).intersection(*postings[1:])
+                     if postings else set())
+            self.search_results = (query, uuids)
+
+        # titles and folders can change without the words changing
+        return {self.note_titles[uuid] for uuid in uuids
+                if uuid in self.note_titles and uuid not in self.views['trash']}
+
+    @writer
     def copy_conflicts(self, response_items):
         response_items = sorted(response_items, key=lambda x: x['created_at'])
         for item in response_items:
-            if item['content_type'] != 'Note':
+            # the server's copy is what's synced now, and if it's what we
+            # last synced anyway there's nothing of it to keep
+            server_hash = content_hash(item['content'])
+            known = self.synced_hashes.get(item['uuid']) == server_hash
+            self.synced_hashes[item['uuid']] = server_hash
+            if known or item['content_type'] != 'Note':
                 continue
 
             old_uuid = item['uuid']
             old_name = item['content']['title']
             old_text = item['content']['text']
             uuid = self.create_note(old_name, old_text)
-            self.items[uuid]['content']['conflict_of'] = old_uuid
-
-    def sync_items(self):
-        dirty_items = [deepcopy(item) for _, item in self.items.items() if item['dirty']]
+            self.edit_content(self.items[uuid])['conflict_of'] = old_uuid
 
-        # remove keys
-        for item in dirty_items:
-            item.pop('dirty', None)
-            item.pop('count', None)
+    def mark_synced(self, response_items, sent_versions, sent_hashes=None):
+        # edits made while the request was in flight stay dirty
+        for item in response_items:
+            uuid = item['uuid']
+            if uuid in sent_versions and self.dirty.get(uuid) == sent_versions[uuid]:
+                del self.dirty[uuid]
+                self.bodies.unpin(uuid)
+                self.touched.discard(uuid)
+                if sent_hashes and uuid in sent_hashes:
+                    self.synced_hashes[uuid] = sent_hashes[uuid]
 
-        response = self.sn_api.sync(dirty_items)
-        self.map_items(response['response_items'])
-        self.map_items(response['saved_items'], metadata_only=True)
-        self.copy_conflicts(response['conflicts'])
-        self.map_items(response['conflicts'], metadata_only=True)
+    def sync_items(self):
+        with self.sync_lock, metrics.timer('snfs_sync_seconds'):
+            for conflict_round in range(MAX_CONFLICT_ROUNDS + 1):
+                conflicts = self._sync_items()
+                if not conflicts:
+                    break
+
+                self.sync_metrics['conflicts'] += conflicts
+                self.sync_metrics['conflict_rounds'] += 1
+
+                # conflicted copies go up together with the local edits next round
+                if conflict_round == MAX_CONFLICT_ROUNDS:
+                    self.sync_metrics['conflict_give_ups'] += 1
+                    logging.error('Still getting sync conflicts after %d rounds, '
+                                  'trying again next sync.' % MAX_CONFLICT_ROUNDS)
+                    break
+                sleep(CONFLICT_BACKOFF_SEC * 2 ** conflict_round)
+
+            # the server was reached, even if it still had conflicts
+            self.last_synced = monotonic()
+
+    def _sync_items(self):
+        start = monotonic()
+
+        # edits replace content instead of changing it, so one shallow copy
+        # per item is a consistent snapshot and the bodies are immutable bytes
+        with self.lock.write():
+            sent_versions = dict(self.dirty)
+            synced_hashes = {uuid: self.synced_hashes.get(uuid)
+                             for uuid in sent_versions}
+            touched = set(self.touched)
+            snapshots = []
+            for uuid in sent_versions:
+                item = dict(self.items[uuid])
+                item.pop('count', None)
+                body = None
+                if item['content_type'] == 'Note' and not item.get('deleted', False):
+                    body = memoryview(self.get_body(uuid))
+                    if uuid in self.padded_notes:
+                        body = body[:-1]
+                snapshots.append((item, body))
+
+        # edits that ended up where the last sync left the item, like an
+        # editor saving without changes, aren't sent again
+        dirty_items = []
+        unchanged_items = []
+        sent_hashes = {}
+        for item, body in snapshots:
+            uuid = item['uuid']
+            if not item.get('deleted', False):
+                sent_hashes[uuid] = content_hash(item['content'],
+                                                 b'' if body is None else body)
+                if (uuid not in touched
+                    and sent_hashes[uuid] == synced_hashes[uuid]):
+                    unchanged_items.append(item)
+                    continue
 
-        if len(response['conflicts']):
-            self.sync_items()
+            if body is not None:
+                item['content'] = dict(item['content'], text=str(body, 'utf-8'))
+            dirty_items.append(item)
+
+        if unchanged_items:
+            with self.lock.write():
+                self.mark_synced(unchanged_items, sent_versions)
+            metrics.inc('snfs_unchanged_items_total', len(unchanged_items),
+                        where='sync')
+
+        conflicts = 0
+
+        # map each page before the next one is fetched, readers only wait
+        # for the mapping, not for the network or decryption
+        for response in self.sn_api.sync(dirty_items):
+            with self.lock.write(), metrics.timer('snfs_sync_phase_seconds',
+                                                  phase='map'):
+                # a change from another client to an item edited here since
+                # the snapshot was taken is a conflict the server can't see
+                retrieved = []
+                overtaken = []
+                for item in response['response_items']:
+                    if item['uuid'] in self.dirty and not item['deleted']:
+                        overtaken.append(item)
+                    else:
+                        retrieved.append(item)
+
+                self.map_items(retrieved)
+                self.map_items(response['saved_items'], metadata_only=True)
+                self.mark_synced(response['saved_items'], sent_versions,
+                                 sent_hashes)
+                # the server's copy becomes a conflicted copy, the local one
+                # stays dirty and pinned and goes up next round over the
+                # server's updated_at, so it never falls back to the cached
+                # server ciphertext
+                self.copy_conflicts(response['conflicts'] + overtaken)
+                self.map_items(response['conflicts'] + overtaken,
+                               metadata_only=True)
+                for item in response['known_conflicts']:
+                    if item['uuid'] in self.items:
+                        self.items[item['uuid']]['updated_at'] = item['updated_at']
+            conflicts += (len(response['conflicts']) + len(overtaken) +
+                          len(response['known_conflicts']))
+
+        trace('sync', dirty_items=len(dirty_items),
+              unchanged_items=len(unchanged_items), conflicts=conflicts,
+              ms=round((monotonic() - start) * 1000, 2))
+        return conflicts
 
     def get_updated(self, item):
         try:
@@ -120,62 +426,164 @@ class ItemManager:
         except KeyError:
             return False
 
+    def store_body(self, uuid, data, pinned=False):
+        # keep notes encoded the way they're read, with a new line so it
+        # outputs pretty, and remember if we added it
+        if data.endswith(b'\n'):
+            self.padded_notes.discard(uuid)
+        else:
+            data += b'\n'
+            self.padded_notes.add(uuid)
+
+        self.body_sizes[uuid] = len(data)
+        self.bodies.put(uuid, data, pinned)
+        return data
+
+    @reader
+    def get_body(self, uuid):
+        data = self.bodies.get(uuid)
+
+        # evicted, decrypt it again from the retained ciphertext
+        if data is None:
+            item = self.sn_api.load_cached_item(uuid)
+            if item is None:
+                logging.error('Note body for %s is missing.' % uuid)
+                raise KeyError(uuid)
+            data = self.store_body(uuid, item['content'].get('text', '').encode())
+
+        return data
+
+    @reader
+    def get_text(self, uuid):
+        data = self.get_body(uuid)
+        if uuid in self.padded_notes:
+            data = data[:-1]
+        return data.decode()
+
+    @reader
     def get_note(self, title):
         item = self.items[self.note_uuids[title]]
-        note = item['content']
-        text = note['text']
-
-        # Add a new line so it outputs pretty
-        if not text.endswith('\n'):
-            text += '\n';
-
-        text = text.encode() # convert to binary data
+        text = self.get_body(item['uuid'])
 
         return dict(note_name=title, text=text, uuid=item['uuid'],
                 created=item['created_at'], inode=item['count'],
                 modified=self.get_updated(item))
 
+    @reader
+    def get_stat(self, uuid):
+        # timestamps are parsed once per change instead of on every stat
+        stat = self.stats.get(uuid)
+        if stat is None:
+            item = self.items[uuid]
+            if item['content_type'] == 'Note':
+                size = self.body_sizes.get(uuid)
+                if size is None:
+                    size = len(self.get_body(uuid))
+            else:
+                size = len(self.tag_notes.get(uuid, ()))
+
+            mtime = self.local_mtimes.get(uuid)
+            if mtime is None:
+                mtime = iso8601.parse_date(self.get_updated(item)).timestamp()
+            stat = dict(size=size, inode=item['count'], mtime=mtime,
+                        ctime=iso8601.parse_date(item['created_at']).timestamp())
+            self.stats[uuid] = stat
+
+        return stat
+
+    @reader
     def get_note_uuid(self, title):
         return self.note_uuids[title]
 
-    def get_notes(self, archived=False, trashed=False):
-        notes = [(k, self.items[v]) for k, v in self.note_uuids.items()]
-
+    def _get_view(self, archived, trashed):
         if archived and trashed:
-            return []
+            return set()
         elif archived:
-            return [k for k, v in notes if self.get_archived(v) and not self.get_trashed(v)]
+            return self.views['archived']
         elif trashed:
-            return [k for k, v in notes if self.get_trashed(v)]
+            return self.views['trash']
         else:
-            return [k for k, v in notes if not (self.get_archived(v) or self.get_trashed(v))]
+            return self.views['notes']
+
+    @reader
+    def get_notes(self, archived=False, trashed=False):
+        notes = self._get_view(archived, trashed)
+        return [self.note_titles[uuid] for uuid in notes]
+
+    @reader
+    def count_notes(self, archived=False, trashed=False):
+        return len(self._get_view(archived, trashed))
+
+    @reader
+    def has_note(self, title, archived=False, trashed=False):
+        return self.note_uuids.get(title) in self._get_view(archived, trashed)
+
+    @reader
+    def get_tag_notes(self, uuid):
+        # only notes that are shown in the root folder are listed in tags
+        notes = self.tag_notes.get(uuid, set())
+        return [self.note_titles[note_uuid] for note_uuid in notes
+                if note_uuid in self.views['notes']]
 
+    @reader
     def get_all_notes(self):
         return [k for k, v in self.note_uuids.items()]
 
+    def edit_content(self, item):
+        # copy on write, a sync may be sending the old content right now
+        content = dict(item['content'])
+        item['content'] = content
+        return content
+
+    def edit_app_data(self, content):
+        app_data = dict(content.get('appData', {}))
+        content['appData'] = app_data
+        ref = dict(app_data.get('org.standardnotes.sn', {}))
+        app_data['org.standardnotes.sn'] = ref
+        return ref
+
     def set_dirty(self, item):
-        item['dirty'] = True
+        self.dirty[item['uuid']] = next(self.versions)
+        self.stats.pop(item['uuid'], None)
+        self.local_mtimes.pop(item['uuid'], None)
 
-        ref = item['content']
-        ref = ref.setdefault('appData', {})
-        ref = ref.setdefault('org.standardnotes.sn', {})
+        ref = self.edit_app_data(self.edit_content(item))
 
         now = datetime.utcnow().isoformat()[:-3] + 'Z'
         ref['client_updated_at'] = now
 
+    @writer
     def touch_note(self, uuid):
+        # sent even if nothing else changed, so other clients see it too
         item = self.items[uuid]
         self.set_dirty(item)
+        self.touched.add(uuid)
 
+    @writer
+    def touch_note_locally(self, uuid, mtime):
+        # only this mount sees it, until the note changes
+        self.local_mtimes[uuid] = mtime
+        self.stats.pop(uuid, None)
+
+    @writer
     def write_note(self, uuid, text):
         item = self.items[uuid]
-        item['content']['text'] = text.decode() # convert back to string
+        if text == self.get_body(uuid):
+            metrics.inc('snfs_unchanged_items_total', where='write')
+            return False
+
+        decoded = text.decode() # make sure it's valid before keeping it
+        self.store_body(uuid, text, pinned=True)
         self.set_dirty(item)
+        self.index_search(uuid, item, decoded)
+        return True
 
+    @writer
     def create_note(self, name, text=''):
         uuid = str(uuid1())
-        content = dict(title=name, text=text, references=[])
+        content = dict(title=name, references=[])
         creation_time = datetime.utcnow().isoformat() + 'Z'
+        self.store_body(uuid, text.encode(), pinned=True)
         self.items[uuid] = dict(content_type='Note', auth_hash=None,
             uuid=uuid, created_at=creation_time, enc_item_key='',
             count=self.item_count, content=content)
@@ -183,50 +591,65 @@ class ItemManager:
         item = self.items[uuid]
         self.cache_item_title(item, self.note_uuids, self.note_titles)
         self.set_dirty(item)
+        self.index_item(uuid, text)
         return uuid
 
+    @writer
     def rename_note(self, uuid, pp):
         item = self.items[uuid]
 
+        archived = self.get_archived(item)
+        trashed = self.get_trashed(item)
+        content = self.edit_content(item)
+
         if pp.parts[1] == 'archived':
-            ref = item['content']
-            ref = ref.setdefault('appData', {})
-            ref = ref.setdefault('org.standardnotes.sn', {})
-            ref['archived'] = True
+            self.edit_app_data(content)['archived'] = True
         elif pp.parts[1] == 'trash':
-            item['content']['trashed'] = True
-        elif self.get_archived(item):
-            item['content']['appData']['org.standardnotes.sn']['archived'] = False
-        elif self.get_trashed(item):
-            item['content']['trashed'] = False
+            content['trashed'] = True
+        elif archived:
+            self.edit_app_data(content)['archived'] = False
+        elif trashed:
+            content['trashed'] = False
 
         new_note_name = pp.stem
-        item['content']['title'] = new_note_name
+        content['title'] = new_note_name
         self.set_dirty(item)
+        self.index_item(uuid)
 
+    @writer
     def delete_note(self, uuid):
         item = self.items[uuid]
 
         if self.get_trashed(item):
             item['deleted'] = True
         else:
-            item['content']['trashed'] = True
+            self.edit_content(item)['trashed'] = True
 
         self.set_dirty(item)
+        self.index_item(uuid)
 
+    @reader
     def get_tag(self, title):
         item = self.items[self.tag_uuids[title]]
-        tag = item['content']
-        references = tag['references']
-        notes = [r['uuid'] for r in references if r['content_type'] == 'Note']
+        notes = self.tag_notes.get(item['uuid'], set())
 
         return dict(tag_name=title, notes=notes, uuid=item['uuid'],
                 created=item['created_at'], inode=item['count'],
                 modified=self.get_updated(item))
 
+    @reader
     def get_tags(self):
-        return self.tag_uuids
+        return dict(self.tag_uuids)
+
+    @reader
+    def get_tag_uuid(self, title):
+        return self.tag_uuids[title]
 
+    @reader
+    def count_tags(self):
+        return len(self.tag_uuids)
+
+    @writer
     def create_tag(self, name):
         uuid = str(uuid1())
         content = dict(title=name, references=[])
@@ -238,35 +661,92 @@ class ItemManager:
         item = self.items[uuid]
         self.cache_item_title(item, self.tag_uuids, self.tag_titles)
         self.set_dirty(item)
+        self.index_item(uuid)
 
+    @writer
     def delete_tag(self, uuid):
         item = self.items[uuid]
         item['deleted'] = True
         self.set_dirty(item)
 
+    @writer
     def tag_note(self, uuid, note_uuid):
         item = self.items[uuid]
         references = item['content']['references']
         note_ref = dict(uuid=note_uuid, content_type='Note')
         if note_ref not in references:
-            references.append(note_ref)
+            self.edit_content(item)['references'] = references + [note_ref]
             self.set_dirty(item)
+            self.index_item(uuid)
 
+    @writer
     def untag_note(self, uuid, note_uuid):
         item = self.items[uuid]
         references = item['content']['references']
         note_ref = dict(uuid=note_uuid, content_type='Note')
-        while note_ref in references:
-            note_index = references.index(note_ref)
-            references.pop(note_index)
+        references = [ref for ref in references if ref != note_ref]
+        self.edit_content(item)['references'] = references
         self.set_dirty(item)
+        self.index_item(uuid)
 
+    @writer
     def rename_tag(self, uuid, name):
         item = self.items[uuid]
-        item['content']['title'] = name
+        self.edit_content(item)['title'] = name
         self.set_dirty(item)
 
-    def __init__(self, sn_api, ext):
+    def __init__(self, sn_api, ext, body_cache_mb=DEFAULT_BUDGET_MB,
+                 search=False):
         self.sn_api = sn_api
         self.ext = ext
+        self.lock = RWLock()
+        self.sync_lock = Lock()
+
+        # the class level defaults would be shared by every manager
+        self.items = {}
+        self.item_count = 0
+        self.note_uuids = {}
+        self.note_titles = {}
+        self.tag_uuids = {}
+        self.tag_titles = {}
+
+        # numbers used to deduplicate each title, so they're found in O(1)
+        self.title_slots = {}
+        self.title_counts = {}
+        self.blocked_titles = {}
+
+        # uuid -> version of its latest local edit, for every unsynced item
+        self.dirty = {}
+        self.versions = count(1)
+
+        # uuid -> content_hash() of the item as the server has it, and
+        # notes touched with a new modified time that must be sent anyway
+        self.synced_hashes = {}
+        self.touched = set()
+        self.local_mtimes = {}
+        self.last_synced = None
+        self.sync_metrics = dict(conflicts=0, conflict_rounds=0,
+                                 conflict_give_ups=0)
+        self.bodies = NoteBodyStore(body_cache_mb)
+        self.padded_notes = set()
+
+        # note uuids in each folder and in each tag, kept up to date as
+        # items change so lookups don't scan every note
+        self.views = dict(notes=set(), archived=set(), trash=set())
+        self.tag_notes = {}
+        self.stats = {}
+        self.body_sizes = {}
+
+        # word -> uuids of the notes with it in their title or text, and
+        # each note's words and title so a change only touches its own
+        self.search_index = {} if search else None
+        self.search_tokens = {}
+        self.search_titles = {}
+        self.search_results = None
+
+        for cached_items in self.sn_api.load_cache():
+            self.map_items(cached_items)
         self.sync_items()
+
+        # crypto workers can't survive FUSE daemonizing, they're restarted later
+        self.sn_api.encryption_helper.shutdown()
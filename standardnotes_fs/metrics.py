@@ -0,0 +1,121 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import math
+from threading import Lock
+from time import monotonic
+
+# upper bounds in seconds, from a cached stat up to a slow sync
+BUCKETS = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+DESCRIPTIONS = dict(
+    snfs_fuse_op_seconds=('histogram', 'Time spent in each FUSE operation.'),
+    snfs_fuse_op_errors_total=('counter', 'FUSE operations that returned an error.'),
+    snfs_sync_seconds=('histogram', 'Time spent in each sync, including conflict rounds.'),
+    snfs_sync_phase_seconds=('histogram', 'Time spent in each phase of a sync.'),
+    snfs_sync_failures_total=('counter', 'Syncs that could not reach the server.'),
+    snfs_crypto_items_total=('counter', 'Items encrypted or decrypted.'),
+    snfs_http_requests_total=('counter', 'Requests made to the sync server.'),
+    snfs_http_sent_bytes_total=('counter', 'Request body bytes sent to the sync server.'),
+    snfs_http_received_bytes_total=('counter', 'Response bytes received from the sync server.'),
+    snfs_dirty_items=('gauge', 'Items with local changes waiting to be synced.'),
+    snfs_last_sync_age_seconds=('gauge', 'Seconds since the last successful sync.'),
+    snfs_notes=('gauge', 'Notes in the mount, archived and trashed ones included.'),
+    snfs_note_cache_bytes=('gauge', 'Decrypted note text held in memory.'),
+    snfs_sync_conflicts_total=('counter', 'Sync conflicts the server reported.'),
+    snfs_sync_conflict_rounds_total=('counter', 'Extra sync rounds run to upload conflicted items.'),
+    snfs_sync_conflict_give_ups_total=('counter', 'Syncs that gave up on repeated conflicts.'),
+    snfs_scheduled_syncs_total=('counter', 'Syncs run by the sync scheduler.'),
+    snfs_merged_changes_total=('counter', 'Local changes merged into scheduled syncs.'),
+    snfs_unchanged_items_total=('counter', 'Writes and dirty items left out because nothing changed.'),
+)
+
+class Histogram:
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def __init__(self):
+        # one extra for +Inf
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+
+lock = Lock()
+counters = {}
+histograms = {}
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+@contextmanager
+def timer(name, **labels):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        observe(name, monotonic() - start, **labels)
+
+def reset():
+    with lock:
+        counters.clear()
+        histograms.clear()
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (k, escape(v)) for k, v in labels) + '}'
+
+def _format_value(value):
+    if isinstance(value, float) and math.isnan(value):
+        return 'NaN'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render(gauges=()):
+    # Prometheus text exposition format, gauges are (name, value) pairs
+    # that the caller reads when the file is opened
+    samples = {}
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            samples.setdefault(name, []).append(
+                    name + _format_labels(labels) + ' ' + _format_value(value))
+
+        for (name, labels), histogram in sorted(histograms.items(),
+                                                 key=lambda x: x[0]):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            bounds = [repr(float(b)) for b in BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, histogram.buckets):
+                cumulative += count
+                lines.append(name + '_bucket' + _format_labels(
+                        labels + (('le', bound),)) + ' ' + str(cumulative))
+            lines.append(name + '_sum' + _format_labels(labels) + ' '
+                         + _format_value(round(histogram.sum, 6)))
+            lines.append(name + '_count' + _format_labels(labels) + ' '
+                         + str(histogram.count))
+
+    for name, value in gauges:
+        samples.setdefault(name, []).append(name + ' ' + _format_value(value))
+
+    output = []
+    for name in sorted(samples):
+        kind, description = DESCRIPTIONS.get(name, ('untyped', ''))
+        output.append('# HELP %s %s' % (name, description))
+        output.append('# TYPE %s %s' % (name, kind))
+        output.extend(samples[name])
+    return '\n'.join(output) + '\n'
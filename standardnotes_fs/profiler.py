@@ -0,0 +1,113 @@
+from collections import Counter
+import logging
+import os
+import pathlib
+import signal
+import sys
+from threading import Event, Lock, Thread, enumerate as enumerate_threads, get_ident
+from time import monotonic, strftime
+
+DEFAULT_PROFILE_SEC = 30
+SAMPLE_INTERVAL_SEC = 0.005
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+class SamplingProfiler:
+    # samples every thread's stack, so it sees the FUSE threads and the sync
+    # thread without hooking into them, and waits on locks show up too
+    def _sample(self, me):
+        names = {thread.ident: thread.name for thread in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name,
+                             os.path.basename(code.co_filename),
+                             code.co_firstlineno))
+                frame = frame.f_back
+
+            stack.append(names.get(ident, 'thread-%d' % ident))
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def _run(self, deadline, stop_event):
+        me = get_ident()
+        while monotonic() < deadline and not stop_event.wait(self.interval):
+            self._sample(me)
+        self._write()
+
+    def _write(self):
+        with self.lock:
+            samples, self.samples = self.samples, Counter()
+            self.thread = None
+
+        path = pathlib.Path(self.output_dir,
+                            'snfs-profile-%s.collapsed' % strftime('%Y%m%d-%H%M%S'))
+        try:
+            with open(str(path), 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write('%s %d\n' % (stack, count))
+            self.last_path = path
+            logging.warning('Wrote %d profile samples to "%s".'
+                            % (sum(samples.values()), path))
+        except OSError:
+            logging.error('Unable to write profile "%s".' % path)
+
+    def start(self, seconds=DEFAULT_PROFILE_SEC):
+        with self.lock:
+            if self.thread:
+                return False
+            self.stop_event = Event()
+            self.thread = Thread(target=self._run, name='snfs-profiler',
+                                 args=(monotonic() + seconds, self.stop_event),
+                                 daemon=True)
+            self.thread.start()
+        logging.warning('Profiling for %d seconds.' % seconds)
+        return True
+
+    def stop(self):
+        with self.lock:
+            thread = self.thread
+            if thread:
+                self.stop_event.set()
+        if thread:
+            thread.join()
+
+    def toggle(self, seconds=DEFAULT_PROFILE_SEC):
+        # a second signal ends the window early
+        if not self.start(seconds):
+            self.stop()
+
+    def __init__(self, output_dir, interval=SAMPLE_INTERVAL_SEC):
+        self.output_dir = str(output_dir)
+        self.interval = interval
+        self.lock = Lock()
+        self.samples = Counter()
+        self.thread = None
+        self.stop_event = None
+        self.last_path = None
+
+def block_profile_signal():
+    # threads started afterwards inherit the mask, so the signal stays
+    # pending until watch_profile_signal() takes it, even while every
+    # thread is inside libfuse
+    if PROFILE_SIGNAL is None or not hasattr(signal, 'sigwait'):
+        return False
+    signal.pthread_sigmask(signal.SIG_BLOCK, [PROFILE_SIGNAL])
+    return True
+
+def watch_profile_signal(profiler, seconds=DEFAULT_PROFILE_SEC):
+    # an unblocked SIGUSR1 would still kill the process, don't pretend
+    if (PROFILE_SIGNAL is None or not hasattr(signal, 'sigwait')
+        or PROFILE_SIGNAL not in signal.pthread_sigmask(signal.SIG_BLOCK, [])):
+        return None
+
+    def watch():
+        while True:
+            signal.sigwait([PROFILE_SIGNAL])
+            profiler.toggle(seconds)
+
+    thread = Thread(target=watch, name='snfs-profile-signal', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import Condition, Lock, get_ident
+
+class RWLock:
+    def acquire_read(self):
+        me = get_ident()
+        with self.cond:
+            # re-entering never waits, or a waiting writer would deadlock us
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.writers_waiting:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = get_ident()
+        with self.cond:
+            self.readers[me] -= 1
+            if not self.readers[me]:
+                del self.readers[me]
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        me = get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError('Cannot upgrade a read lock to a write lock.')
+
+            self.writers_waiting += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = me
+            self.write_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if not self.write_depth:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.readers = {}
+        self.writer = None
+        self.write_depth = 0
+        self.writers_waiting = 0
+
+def reader(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def writer(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
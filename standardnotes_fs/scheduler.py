@@ -0,0 +1,84 @@
+import logging
+from threading import Condition, Thread
+from time import monotonic
+
+DEFAULT_QUIET_SEC = 0.5
+DEFAULT_MAX_DELAY_SEC = 5
+
+class SyncScheduler:
+    def _next_sync(self):
+        if self.pending:
+            # wait for changes to settle, but never longer than max_delay
+            return min(self.last_change + self.quiet_sec,
+                       self.first_change + self.max_delay_sec)
+        else:
+            return self.last_sync + self.interval
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stopped:
+                    wait = self._next_sync() - monotonic()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+
+                merged = self.pending
+                self.pending = 0
+                self.first_change = None
+                stopped = self.stopped
+
+            if merged:
+                logging.info('Syncing %d merged local changes...' % merged)
+            else:
+                logging.info('Auto-syncing items...')
+
+            # a failed sync leaves its items dirty for the next one, the
+            # thread has to outlive it or nothing is ever synced again
+            try:
+                self.sync()
+            except Exception:
+                logging.exception('Sync failed, trying again later.')
+            self.last_sync = monotonic()
+            self.syncs += 1
+            self.changes_merged += merged
+
+            # one last sync happens on stop so nothing local is left behind
+            if stopped:
+                return
+
+    def notify(self):
+        with self.cond:
+            now = monotonic()
+            self.pending += 1
+            self.last_change = now
+            if self.first_change is None:
+                self.first_change = now
+            self.cond.notify()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join()
+
+    def __init__(self, sync, interval, quiet_sec=DEFAULT_QUIET_SEC,
+                 max_delay_sec=DEFAULT_MAX_DELAY_SEC):
+        self.sync = sync
+        self.interval = interval
+        self.quiet_sec = quiet_sec
+        self.max_delay_sec = max(quiet_sec, max_delay_sec)
+
+        self.cond = Condition()
+        self.pending = 0
+        self.first_change = None
+        self.last_change = None
+        self.last_sync = monotonic()
+        self.stopped = False
+
+        self.syncs = 0
+        self.changes_merged = 0
+        self.thread = Thread(target=self._run, name='snfs-sync')
@@ -1,29 +1,49 @@
 from datetime import datetime
 import errno
+from itertools import count
 import logging
 import os
 from pathlib import PurePath
 from stat import S_IFDIR, S_IFREG
-from threading import Event, Thread
-from time import sleep
+from threading import RLock
+from time import monotonic, time
 
 from fuse import FuseOSError, LoggingMixIn, Operations
-import iso8601
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 
+from standardnotes_fs import metrics
+from standardnotes_fs.bodystore import DEFAULT_BUDGET_MB
 from standardnotes_fs.itemmanager import ItemManager
+from standardnotes_fs.profiler import (DEFAULT_PROFILE_SEC, SamplingProfiler,
+                                       watch_profile_signal)
+from standardnotes_fs.scheduler import (DEFAULT_MAX_DELAY_SEC, DEFAULT_QUIET_SEC,
+                                        SyncScheduler)
+from standardnotes_fs.trace import debug_enabled
 
 DIR_PERMISSIONS = 0o750
 FILE_PERMISSIONS = 0o640
+STATS_PERMISSIONS = 0o440
 ROOT_INODE = 0
 TAGS_INODE = 1
 TRASH_INODE = 2
 ARCHIVED_INODE = 3
+STATS_INODE = 4
+SEARCH_INODE = 5
 INODE_OFFSET = 100
 
+# not listed in the root so backups and grep -r don't pick it up
+STATS_PATH = '/.snfs-stats'
+MODIFY_OPS = ['chmod', 'chown', 'create', 'mkdir', 'rename', 'rmdir',
+              'symlink', 'truncate', 'unlink', 'utimens', 'write']
+
 class StandardNotesFUSE(LoggingMixIn, Operations):
-    def __init__(self, sn_api, sync_sec, ext, path='.'):
-        self.item_manager = ItemManager(sn_api, ext)
+    def __init__(self, sn_api, sync_sec, ext, path='.',
+                 body_cache_mb=DEFAULT_BUDGET_MB, quiet_sec=DEFAULT_QUIET_SEC,
+                 max_delay_sec=DEFAULT_MAX_DELAY_SEC, profile_dir=None,
+                 profile_sec=DEFAULT_PROFILE_SEC, remote_touch=False,
+                 search=False):
+        self.item_manager = ItemManager(sn_api, ext, body_cache_mb, search)
+        self.search = search
 
         self.uid = os.getuid()
         self.gid = os.getgid()
@@ -37,42 +57,95 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
                               st_mtime=now, st_atime=now, st_nlink=1,
                               st_uid=self.uid, st_gid=self.gid)
 
+        self.stats_stat = dict(self.note_stat, st_ino=STATS_INODE,
+                               st_mode=(S_IFREG | STATS_PERMISSIONS))
+        self.stats_text = b''
+        self.stats_handles = {}
+
+        # buffered writes per open note, shared by its file handles
+        self.open_notes = {}
+        self.handles = {}
+        self.fh_counter = count(1)
+        self.handle_lock = RLock()
+
         self.sync_sec = sync_sec
         self.ext = ext
-        self.run_sync = Event()
-        self.stop_sync = Event()
-        self.sync_thread = Thread(target=self._sync_thread)
+        self.sync_scheduler = SyncScheduler(self._sync, sync_sec,
+                                            quiet_sec, max_delay_sec)
+
+        self.profiler = SamplingProfiler(profile_dir) if profile_dir else None
+        self.profile_sec = profile_sec
+        self.remote_touch = remote_touch
+
+    def __call__(self, op, path, *args):
+        start = monotonic()
+        try:
+            if op in MODIFY_OPS and STATS_PATH in (path,) + args[:1]:
+                raise FuseOSError(errno.EACCES)
+            # LoggingMixIn formats every op's arguments and result up front,
+            # even when the debug lines are dropped
+            if debug_enabled():
+                return super().__call__(op, path, *args)
+            return Operations.__call__(self, op, path, *args)
+        except OSError as e:
+            metrics.inc('snfs_fuse_op_errors_total', op=op,
+                        errno=errno.errorcode.get(e.errno, e.errno))
+            raise
+        finally:
+            metrics.observe('snfs_fuse_op_seconds', monotonic() - start, op=op)
 
     def init(self, path):
-        self.sync_thread.start()
+        self.sync_scheduler.start()
+
+        # started here, threads from before FUSE daemonizes don't survive
+        if self.profiler:
+            watch_profile_signal(self.profiler, self.profile_sec)
 
     def destroy(self, path):
-        self.run_sync.set()
         logging.info('Stopping sync thread.')
-        self.stop_sync.set()
-        self.sync_thread.join()
+        self.sync_scheduler.stop()
+        if self.profiler:
+            self.profiler.stop()
+        self.item_manager.sn_api.encryption_helper.shutdown()
         return 0
 
-    def _sync_thread(self):
-        while not self.stop_sync.is_set():
-            self.run_sync.clear()
-            manually_synced = self.run_sync.wait(timeout=self.sync_sec)
-            if not manually_synced: logging.info('Auto-syncing items...')
-            sleep(0.1) # fixes race condition of quick create() then write()
-            try:
-                self.item_manager.sync_items()
-            except ConnectionError:
-                logging.error('Unable to connect to sync server.')
+    def _sync(self):
+        try:
+            self.item_manager.sync_items()
+        except (ConnectionError, Timeout):
+            metrics.inc('snfs_sync_failures_total')
+            logging.error('Unable to connect to sync server.')
+
+    def _render_stats(self):
+        manager = self.item_manager
+        last_synced = manager.last_synced
+        notes = (manager.count_notes() + manager.count_notes(archived=True)
+                 + manager.count_notes(trashed=True))
+
+        return metrics.render([
+            ('snfs_dirty_items', len(manager.dirty)),
+            ('snfs_last_sync_age_seconds', round(monotonic() - last_synced, 3)
+                if last_synced is not None else float('nan')),
+            ('snfs_notes', notes),
+            ('snfs_note_cache_bytes', manager.bodies.size),
+            ('snfs_sync_conflicts_total', manager.sync_metrics['conflicts']),
+            ('snfs_sync_conflict_rounds_total',
+                manager.sync_metrics['conflict_rounds']),
+            ('snfs_sync_conflict_give_ups_total',
+                manager.sync_metrics['conflict_give_ups']),
+            ('snfs_scheduled_syncs_total', self.sync_scheduler.syncs),
+            ('snfs_merged_changes_total', self.sync_scheduler.changes_merged),
+        ]).encode()
 
     def _modify_sync(self):
-        self.run_sync.set()
+        # bursts of changes are merged into one sync by the scheduler
+        self.sync_scheduler.notify()
 
     def _path_to_tag(self, path):
         pp = PurePath(path)
         if pp.parts[1] == 'tags':
             tag_name = pp.parts[2]
-            tag = self.item_manager.get_tag(tag_name)
-            return tag, tag_name, tag['uuid']
+            return tag_name, self.item_manager.get_tag_uuid(tag_name)
         else:
             raise KeyError
 
@@ -82,59 +155,104 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
         note = self.item_manager.get_note(note_name)
         return note, note_name, note['uuid']
 
+    def _open_buffer(self, uuid, note):
+        open_note = self.open_notes.get(uuid)
+        if not open_note:
+            return None
+
+        # only copy the note once it's actually written to
+        if open_note['buffer'] is None:
+            open_note['buffer'] = bytearray(note['text'])
+        return open_note
+
+    def _commit(self, uuid):
+        open_note = self.open_notes.get(uuid)
+        if not open_note or not open_note['dirty']:
+            return
+
+        changed = False
+        try:
+            changed = self.item_manager.write_note(uuid, bytes(open_note['buffer']))
+        except UnicodeError:
+            logging.error('Unable to parse non-unicode data.')
+            raise FuseOSError(errno.EIO)
+        except KeyError:
+            logging.info('Note was removed while it was open.')
+
+        open_note['dirty'] = False
+        if changed:
+            self._modify_sync()
+
+    def _item_attr(self, stat, uuid):
+        item_stat = self.item_manager.get_stat(uuid)
+        return dict(stat, st_size=item_stat['size'],
+                    st_ino=item_stat['inode'] + INODE_OFFSET,
+                    st_ctime=item_stat['ctime'], st_mtime=item_stat['mtime'])
+
     def note_attr(self, path):
-        note, note_name, uuid = self._path_to_note(path)
-        st = self.note_stat
-        st['st_size'] = len(note['text'])
-        st['st_ino'] = note['inode'] + INODE_OFFSET
-        st['st_ctime'] = iso8601.parse_date(note['created']).timestamp()
-        st['st_mtime'] = iso8601.parse_date(note['modified']).timestamp()
+        uuid = self.item_manager.get_note_uuid(PurePath(path).name)
+        st = self._item_attr(self.note_stat, uuid)
+        open_note = self.open_notes.get(uuid)
+        if open_note and open_note['buffer'] is not None:
+            st['st_size'] = len(open_note['buffer'])
         return st
 
     def getattr(self, path, fh=None):
         pp = PurePath(path)
 
         try:
-            if path == '/':
-                notes = self.item_manager.get_notes()
-                st = dict(self.dir_stat, st_ino=ROOT_INODE, st_size=len(notes))
+            if path == STATS_PATH:
+                # rendered here so the size matches what open() hands out
+                self.stats_text = self._render_stats()
+                now = datetime.now().timestamp()
+                st = dict(self.stats_stat, st_size=len(self.stats_text),
+                          st_mtime=now, st_ctime=now)
+            elif path == '/':
+                notes = self.item_manager.count_notes()
+                st = dict(self.dir_stat, st_ino=ROOT_INODE, st_size=notes)
             elif pp.parts[1] == 'tags':
                 if len(pp.parts) == 3:
-                    tag, tag_name, uuid = self._path_to_tag(path)
-                    st = self.dir_stat
-                    st['st_size'] = len(tag['notes'])
-                    st['st_ino'] = tag['inode'] + INODE_OFFSET
-                    st['st_ctime'] = iso8601.parse_date(tag['created']).timestamp()
-                    st['st_mtime'] = iso8601.parse_date(tag['modified']).timestamp()
+                    uuid = self.item_manager.get_tag_uuid(pp.parts[2])
+                    st = self._item_attr(self.dir_stat, uuid)
                 elif len(pp.parts) == 4:
-                    tag, tag_name, tag_uuid = self._path_to_tag(path)
-                    note, note_name, note_uuid = self._path_to_note(path)
+                    tag = self.item_manager.get_tag(pp.parts[2])
+                    note_uuid = self.item_manager.get_note_uuid(pp.name)
                     if note_uuid in tag['notes']:
                         st = self.getattr('/' + pp.name) # recursion
                     else:
                         raise KeyError
                 else:
-                    tags = self.item_manager.get_tags()
-                    st = dict(self.dir_stat, st_ino=TAGS_INODE, st_size=len(tags))
+                    tags = self.item_manager.count_tags()
+                    st = dict(self.dir_stat, st_ino=TAGS_INODE, st_size=tags)
             elif pp.parts[1] == 'archived':
-                notes = self.item_manager.get_notes(archived=True)
-
                 if len(pp.parts) == 3:
-                    if pp.name not in notes: raise KeyError
+                    if not self.item_manager.has_note(pp.name, archived=True):
+                        raise KeyError
                     st = self.note_attr(path)
                 else:
-                    st = dict(self.dir_stat, st_ino=ARCHIVED_INODE, st_size=len(notes))
+                    notes = self.item_manager.count_notes(archived=True)
+                    st = dict(self.dir_stat, st_ino=ARCHIVED_INODE, st_size=notes)
             elif pp.parts[1] == 'trash':
-                notes = self.item_manager.get_notes(trashed=True)
-
                 if len(pp.parts) == 3:
-                    if pp.name not in notes: raise KeyError
+                    if not self.item_manager.has_note(pp.name, trashed=True):
+                        raise KeyError
+                    st = self.note_attr(path)
+                else:
+                    notes = self.item_manager.count_notes(trashed=True)
+                    st = dict(self.dir_stat, st_ino=TRASH_INODE, st_size=notes)
+            elif pp.parts[1] == 'search' and self.search:
+                # any directory name in here is a query, so every one exists
+                if len(pp.parts) == 3:
+                    results = self.item_manager.search_notes(pp.parts[2])
+                    st = dict(self.dir_stat, st_size=len(results))
+                elif len(pp.parts) == 4:
+                    if pp.name not in self.item_manager.search_notes(pp.parts[2]):
+                        raise KeyError
                     st = self.note_attr(path)
                 else:
-                    st = dict(self.dir_stat, st_ino=TRASH_INODE, st_size=len(notes))
+                    st = dict(self.dir_stat, st_ino=SEARCH_INODE, st_size=0)
             else:
-                notes = self.item_manager.get_notes()
-                if pp.name not in notes: raise KeyError
+                if not self.item_manager.has_note(pp.name): raise KeyError
                 st = self.note_attr(path)
         except KeyError:
             raise FuseOSError(errno.ENOENT)
@@ -156,18 +274,15 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
 
         if path == '/':
             dirents.extend(self.item_manager.get_notes())
-            tags = self.item_manager.get_tags()
-            if len(tags): dirents.append('tags')
-            archived = self.item_manager.get_notes(archived=True)
-            if archived: dirents.append('archived')
-            trashed = self.item_manager.get_notes(trashed=True)
-            if trashed: dirents.append('trash')
+            if self.item_manager.count_tags(): dirents.append('tags')
+            if self.item_manager.count_notes(archived=True):
+                dirents.append('archived')
+            if self.item_manager.count_notes(trashed=True):
+                dirents.append('trash')
         elif pp.parts[1] == 'tags':
             if len(pp.parts) == 3:
-                tag, tag_name, uuid = self._path_to_tag(path)
-                notes = [note for note in self.item_manager.get_notes()
-                    if self.item_manager.get_note_uuid(note) in tag['notes']]
-                dirents.extend(notes)
+                tag_name, uuid = self._path_to_tag(path)
+                dirents.extend(self.item_manager.get_tag_notes(uuid))
             else:
                 tags = self.item_manager.get_tags()
                 dirents.extend(list(tags.keys()))
@@ -177,39 +292,116 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
         elif pp.parts[1] == 'trash':
             trashed = self.item_manager.get_notes(trashed=True)
             dirents.extend(trashed)
+        elif pp.parts[1] == 'search' and self.search:
+            if len(pp.parts) == 3:
+                dirents.extend(self.item_manager.search_notes(pp.parts[2]))
 
         return dirents
 
+    def open(self, path, flags):
+        if path == STATS_PATH:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise FuseOSError(errno.EACCES)
+            with self.handle_lock:
+                fh = next(self.fh_counter)
+                self.stats_handles[fh] = self.stats_text or self._render_stats()
+                return fh
+
+        with self.handle_lock:
+            note, note_name, uuid = self._path_to_note(path)
+            open_note = self.open_notes.setdefault(uuid,
+                    dict(buffer=None, dirty=False, refs=0))
+            open_note['refs'] += 1
+
+            fh = next(self.fh_counter)
+            self.handles[fh] = uuid
+            return fh
+
     def read(self, path, size, offset, fh):
+        with self.handle_lock:
+            stats_text = self.stats_handles.get(fh)
+            if stats_text is not None:
+                return stats_text[offset : offset + size]
+
+            open_note = self.open_notes.get(self.handles.get(fh))
+            if open_note and open_note['buffer'] is not None:
+                with memoryview(open_note['buffer']) as view:
+                    return view[offset : offset + size].tobytes()
+
+        # the note is cached already encoded, this only copies the slice
         note, note_name, uuid = self._path_to_note(path)
         return note['text'][offset : offset + size]
 
     def truncate(self, path, length, fh=None):
-        note, note_name, uuid = self._path_to_note(path)
-        text = note['text'][:length]
-        self.item_manager.write_note(uuid, text)
-        self._modify_sync()
-        return 0
+        with self.handle_lock:
+            note, note_name, uuid = self._path_to_note(path)
+
+            open_note = self._open_buffer(uuid, note)
+            if open_note:
+                buf = open_note['buffer']
+                del buf[length:]
+                buf.extend(bytes(length - len(buf)))
+                open_note['dirty'] = True
+                return 0
+
+            text = note['text'][:length]
+            if self.item_manager.write_note(uuid, text):
+                self._modify_sync()
+            return 0
 
     def write(self, path, data, offset, fh):
-        note, note_name, uuid = self._path_to_note(path)
-        text = note['text'][:offset] + data
+        with self.handle_lock:
+            uuid = self.handles.get(fh)
+            if uuid is None:
+                note, note_name, uuid = self._path_to_note(path)
+                fh = self.open(path, os.O_WRONLY)
+                self.write(path, data, offset, fh)
+                self.release(path, fh)
+                return len(data)
+
+            open_note = self.open_notes[uuid]
+            if open_note['buffer'] is None:
+                note, note_name, uuid = self._path_to_note(path)
+                self._open_buffer(uuid, note)
+
+            # writes go to the buffer, the note is only rebuilt on flush
+            buf = open_note['buffer']
+            if offset > len(buf):
+                buf.extend(bytes(offset - len(buf)))
+            buf[offset : offset + len(data)] = data
+            open_note['dirty'] = True
+
+            return len(data)
+
+    def flush(self, path, fh):
+        with self.handle_lock:
+            self._commit(self.handles.get(fh))
+            return 0
 
-        try:
-            self.item_manager.write_note(uuid, text)
-        except UnicodeError:
-            logging.error('Unable to parse non-unicode data.')
-            raise FuseOSError(errno.EIO)
+    def fsync(self, path, datasync, fh):
+        return self.flush(path, fh)
 
-        self._modify_sync()
-        return len(data)
+    def release(self, path, fh):
+        with self.handle_lock:
+            self.stats_handles.pop(fh, None)
+            uuid = self.handles.pop(fh, None)
+            try:
+                self._commit(uuid)
+            finally:
+                open_note = self.open_notes.get(uuid)
+                if open_note:
+                    open_note['refs'] -= 1
+                    if open_note['refs'] <= 0:
+                        del self.open_notes[uuid]
+            return 0
 
     def create(self, path, mode):
         pp = PurePath(path)
         note_name = pp.name
 
         # disallow created notes in these directories
-        if len(pp.parts) < 4 and pp.parts[1] in ['tags', 'archived', 'trash']:
+        if ((len(pp.parts) < 4 and pp.parts[1] in ['tags', 'archived', 'trash'])
+            or pp.parts[1] == 'search'):
             logging.error('Unable to create files in that directory.')
             raise FuseOSError(errno.EPERM)
 
@@ -232,17 +424,21 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
         note_uuid = self.item_manager.create_note(title)
 
         if pp.parts[1] == 'tags':
-            tag, tag_name, tag_uuid = self._path_to_tag(path)
+            tag_name, tag_uuid = self._path_to_tag(path)
             self.item_manager.tag_note(tag_uuid, note_uuid)
 
         self._modify_sync()
-        return 0
+        return self.open(path, os.O_WRONLY)
 
     def unlink(self, path):
         pp = PurePath(path)
 
+        if pp.parts[1] == 'search':
+            logging.error('Unable to delete notes from search results.')
+            raise FuseOSError(errno.EPERM)
+
         if pp.parts[1] == 'tags':
-            tag, tag_name, tag_uuid = self._path_to_tag(path)
+            tag_name, tag_uuid = self._path_to_tag(path)
             note, note_name, note_uuid = self._path_to_note(path)
             self.item_manager.untag_note(tag_uuid, note_uuid)
             self._modify_sync()
@@ -271,14 +467,22 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
             raise FuseOSError(errno.EPERM)
 
         note, note_name, uuid = self._path_to_note(path)
-        self.item_manager.touch_note(uuid)
-        self._modify_sync()
+        if self.remote_touch:
+            self.item_manager.touch_note(uuid)
+            self._modify_sync()
+        else:
+            mtime = times[1] if times else time()
+            self.item_manager.touch_note_locally(uuid, mtime)
         return 0
 
     def rename(self, old, new):
         pp_old = PurePath(old)
         pp_new = PurePath(new)
 
+        if 'search' in [pp_old.parts[1], pp_new.parts[1]]:
+            logging.error('Unable to move notes in or out of search results.')
+            raise FuseOSError(errno.EPERM)
+
         # rename, archive, trash note
         if pp_old.parts[1] != 'tags' and pp_new.parts[1] != 'tags':
             note, note_name, uuid = self._path_to_note(old)
@@ -289,7 +493,7 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
         # rename tag
         if (len(pp_old.parts) == 3 and len(pp_new.parts) == 3
             and pp_old.parts[1] == 'tags' and pp_new.parts[1] == 'tags'):
-            tag, tag_name, tag_uuid = self._path_to_tag(old)
+            tag_name, tag_uuid = self._path_to_tag(old)
             self.item_manager.rename_tag(tag_uuid, pp_new.name)
             self._modify_sync()
             return 0
@@ -300,7 +504,7 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
 
         # tag note
         if pp_new.parts[1] == 'tags' and len(pp_new.parts) == 4:
-            tag, tag_name, tag_uuid = self._path_to_tag(new)
+            tag_name, tag_uuid = self._path_to_tag(new)
             note, note_name, note_uuid = self._path_to_note(old)
             self.item_manager.tag_note(tag_uuid, note_uuid)
         else:
@@ -328,7 +532,7 @@ class StandardNotesFUSE(LoggingMixIn, Operations):
         pp = PurePath(path)
 
         if pp.parts[1] == 'tags' and len(pp.parts) == 3:
-            tag, tag_name, uuid = self._path_to_tag(path)
+            tag_name, uuid = self._path_to_tag(path)
             self.item_manager.delete_tag(uuid)
             self._modify_sync()
             return 0
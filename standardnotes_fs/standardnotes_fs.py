@@ -6,14 +6,25 @@ import sys
 import os
 import pathlib
 import platform
+import sqlite3
 import subprocess
 
 import appdirs
 from fuse import FUSE
-from requests.exceptions import ConnectionError, MissingSchema
+from requests.exceptions import ConnectionError, MissingSchema, Timeout
 
-from standardnotes_fs.api import SNAPIException, StandardNotesAPI
+from standardnotes_fs.api import (DEFAULT_PAGE_SIZE, DEFAULT_POOL_SIZE,
+                                  DEFAULT_TIMEOUT, SNAPIException,
+                                  StandardNotesAPI)
+from standardnotes_fs.bodystore import DEFAULT_BUDGET_MB
+from standardnotes_fs.cache import ItemCache
+from standardnotes_fs import crypt_bench
+from standardnotes_fs.crypt import DEFAULT_WORKERS
+from standardnotes_fs.crypt_backends import BACKENDS, DEFAULT_BACKEND
+from standardnotes_fs.profiler import DEFAULT_PROFILE_SEC, block_profile_signal
+from standardnotes_fs.scheduler import DEFAULT_MAX_DELAY_SEC, DEFAULT_QUIET_SEC
 from standardnotes_fs.sn_fuse import StandardNotesFUSE
+from standardnotes_fs.trace import enable_trace
 
 OFFICIAL_SERVER_URL = 'https://sync.standardnotes.org'
 DEFAULT_SYNC_SEC = 30
@@ -28,9 +39,12 @@ CONFIG_FILE = pathlib.PurePath(CONFIG_PATH, APP_NAME + '.conf')
 cfg_env = os.environ.get('SN_FS_CREDS_PATH')
 CREDS_PATH = cfg_env if cfg_env else appdirs.user_cache_dir(APP_NAME)
 CREDS_FILE = pathlib.PurePath(CREDS_PATH, APP_NAME + '.conf')
+CACHE_FILE = pathlib.PurePath(CREDS_PATH, APP_NAME + '-items.db')
 
 def parse_options():
-    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     epilog='run "snfs bench-crypto --help" to '
+                                     'compare the crypto backends')
     parser.add_argument('mountpoint', nargs='?', help='local mountpoint folder')
     parser.add_argument('--username',
                         help='Standard Notes username to log in with')
@@ -41,17 +55,58 @@ def parse_options():
                              '      use the password prompt instead.')
     parser.add_argument('-v', '--verbosity', action='count',
                         help='output verbosity -v or -vv (implies --foreground)')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write sync sizes and timings to FILE as JSON lines')
+    parser.add_argument('--profile-sec', type=int, default=DEFAULT_PROFILE_SEC,
+                        help='how long to profile after a SIGUSR1, the profile\n'
+                        'is written next to the item cache. Default: '
+                        ''+str(DEFAULT_PROFILE_SEC))
     parser.add_argument('--foreground', action='store_true',
                         help='run standardnotes-fs in the foreground')
     parser.add_argument('--sync-sec', type=int, default=DEFAULT_SYNC_SEC,
                         help='how many seconds between each sync. Default: '
                         ''+str(DEFAULT_SYNC_SEC))
+    parser.add_argument('--sync-quiet-sec', type=float, default=DEFAULT_QUIET_SEC,
+                        help='how long changes must settle before they are\n'
+                        'synced. Default: '+str(DEFAULT_QUIET_SEC))
+    parser.add_argument('--sync-max-delay', type=float,
+                        default=DEFAULT_MAX_DELAY_SEC,
+                        help='most seconds a change waits to be synced.\n'
+                        'Default: '+str(DEFAULT_MAX_DELAY_SEC))
     parser.add_argument('--sync-url',
                         help='URL of Standard File sync server. Defaults to:\n'
                         ''+OFFICIAL_SERVER_URL)
+    parser.add_argument('--sync-page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='how many items to download per sync request.\n'
+                        'Default: '+str(DEFAULT_PAGE_SIZE))
+    parser.add_argument('--crypto-workers', type=int, default=DEFAULT_WORKERS,
+                        help='processes used to encrypt / decrypt large syncs,\n'
+                        '0 uses every CPU. Default: '+str(DEFAULT_WORKERS))
+    parser.add_argument('--crypto-backend', default=DEFAULT_BACKEND,
+                        choices=[backend.name for backend in BACKENDS],
+                        help='AES implementation to use, "openssl" needs the\n'
+                        'cryptography package. Default: '+DEFAULT_BACKEND)
+    parser.add_argument('--http-timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='seconds to wait for the sync server. Default: '
+                        ''+str(DEFAULT_TIMEOUT))
+    parser.add_argument('--http-pool-size', type=int, default=DEFAULT_POOL_SIZE,
+                        help='number of kept-alive connections to the sync\n'
+                        'server. Default: '+str(DEFAULT_POOL_SIZE))
+    parser.add_argument('--compress-requests', action='store_true',
+                        help='gzip request bodies sent to the sync server\n'
+                        '(the server must support this)')
+    parser.add_argument('--remote-touch', action='store_true',
+                        help='sync the new modified time of touched notes,\n'
+                        'instead of only changing it in this mount')
+    parser.add_argument('--search', action='store_true',
+                        help='index the words in notes for the search folder,\n'
+                        'this keeps every word of every note in memory')
     parser.add_argument('--ext', default=DEFAULT_EXT,
                         help='file extension to add to note titles. Default: '
                         ''+DEFAULT_EXT)
+    parser.add_argument('--note-cache-mb', type=int, default=DEFAULT_BUDGET_MB,
+                        help='memory used to keep decrypted notes around,\n'
+                        'in MB. Default: '+str(DEFAULT_BUDGET_MB))
     parser.add_argument('--no-config-files', action='store_true',
                         help='don\'t load or create config / cred files')
     parser.add_argument('--config', default=CONFIG_FILE,
@@ -60,6 +115,11 @@ def parse_options():
     parser.add_argument('--creds', default=CREDS_FILE,
                         help='specify a credentials file location. Defaults to:\n'
                         ''+str(CREDS_FILE))
+    parser.add_argument('--cache', default=CACHE_FILE,
+                        help='specify an encrypted item cache location. Defaults to:\n'
+                        ''+str(CACHE_FILE))
+    parser.add_argument('--threads', action='store_true',
+                        help='serve file operations from multiple threads')
     parser.add_argument('--allow-other', action='store_true',
                         help='allow other system users access')
     parser.add_argument('--logout', action='store_true',
@@ -69,6 +129,11 @@ def parse_options():
     return parser.parse_args()
 
 def main():
+    # subcommands don't mount anything, so they skip the usual options
+    if sys.argv[1:2] == ['bench-crypto']:
+        crypt_bench.main(sys.argv[2:])
+        sys.exit(0)
+
     args = parse_options()
     config = ConfigParser()
     creds = ConfigParser()
@@ -85,10 +150,12 @@ def main():
     logging.basicConfig(level=log_level,
                         format='%(levelname)-8s: %(message)s')
     if args.verbosity: args.foreground = True
+    if args.trace: enable_trace(args.trace)
 
     # figure out config files
     config_file = pathlib.Path(args.config)
     creds_file = pathlib.Path(args.creds)
+    cache_file = pathlib.Path(args.cache)
 
     # remove config and quit if wanted
     if args.logout:
@@ -100,6 +167,10 @@ def main():
             creds_file.unlink()
         except OSError:
             logging.info('No creds file found.')
+        try:
+            cache_file.unlink()
+        except OSError:
+            logging.info('No item cache found.')
         print('Config files removed.')
         if not args.unmount: sys.exit(0)
 
@@ -200,7 +271,14 @@ def main():
 
     # log the user in
     try:
-        sn_api = StandardNotesAPI(sync_url, username)
+        sn_api = StandardNotesAPI(sync_url, username,
+                                  timeout=args.http_timeout,
+                                  pool_size=args.http_pool_size,
+                                  compress=args.compress_requests,
+                                  page_size=max(1, args.sync_page_size),
+                                  crypto_workers=(args.crypto_workers or
+                                                  os.cpu_count() or 1),
+                                  crypto_backend=args.crypto_backend)
         if not keys:
             keys = sn_api.gen_keys(password)
             del password
@@ -210,7 +288,7 @@ def main():
         login_success = True
     except SNAPIException as e:
         print(e)
-    except ConnectionError:
+    except (ConnectionError, Timeout):
         log_msg = 'Unable to connect to the sync server at "%s".'
         print(log_msg % sync_url)
         sys.exit(1)
@@ -218,6 +296,9 @@ def main():
         log_msg = 'Invalid sync server url "%s".'
         print(log_msg % sync_url)
         sys.exit(1)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
     # write config back if good, clear if not
     if not args.no_config_files:
@@ -255,14 +336,38 @@ def main():
             print(log_msg % str(creds_file))
 
     if login_success:
+        if not args.no_config_files:
+            try:
+                cache_file.parent.mkdir(mode=0o0700, parents=True, exist_ok=True)
+                sn_api.cache = ItemCache(cache_file)
+                log_msg = 'Using item cache "%s".'
+                logging.info(log_msg % str(cache_file))
+            except (OSError, sqlite3.Error):
+                log_msg = 'Unable to open item cache "%s".'
+                print(log_msg % str(cache_file))
+
+        # profiles go next to the cache, and to the working dir without one
+        if block_profile_signal():
+            profile_dir = (cache_file.parent if not args.no_config_files
+                           else pathlib.Path.cwd())
+        else:
+            profile_dir = None
+
         logging.info('Starting FUSE filesystem.')
         try:
-            fuse = FUSE(StandardNotesFUSE(sn_api, sync_sec, args.ext),
+            fuse = FUSE(StandardNotesFUSE(sn_api, sync_sec, args.ext,
+                                          body_cache_mb=args.note_cache_mb,
+                                          quiet_sec=args.sync_quiet_sec,
+                                          max_delay_sec=args.sync_max_delay,
+                                          profile_dir=profile_dir,
+                                          profile_sec=max(1, args.profile_sec),
+                                          remote_touch=args.remote_touch,
+                                          search=args.search),
                         args.mountpoint, use_ino=True,
                         foreground=args.foreground,
                         allow_other=args.allow_other,
                         default_permissions=True,
-                        nothreads=True) # FUSE can't make threads, but we can
+                        nothreads=not args.threads)
         except RuntimeError as e:
             print('Error mounting file system.')
 
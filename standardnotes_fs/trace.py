@@ -0,0 +1,25 @@
+import json
+import logging
+from time import time
+
+# records only sizes and timings, never item contents or keys
+trace_logger = logging.getLogger('standardnotes_fs.trace')
+trace_logger.propagate = False
+trace_logger.setLevel(logging.CRITICAL + 1)
+
+def debug_enabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+def trace_enabled():
+    return trace_logger.isEnabledFor(logging.INFO)
+
+def enable_trace(path):
+    handler = logging.FileHandler(str(path))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+
+def trace(event, **fields):
+    if trace_enabled():
+        fields.update(event=event, time=round(time(), 3))
+        trace_logger.info(json.dumps(fields, sort_keys=True))